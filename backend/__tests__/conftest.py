@@ -10,6 +10,8 @@ from strawberry_sqlalchemy_mapper import StrawberrySQLAlchemyLoader
 
 from .. import models as m
 from .. import schema as s
+from .. import users
+from ..loaders import Loaders
 
 
 @pytest.fixture
@@ -17,6 +19,7 @@ def db() -> Session:
     engine = create_engine("sqlite://", echo=False)
     db = Session(engine)
     m.SECURE = False
+    users.cache.clear()
     m.Base.metadata.create_all(engine)
     m.populate_example_data(db)
     return db
@@ -42,6 +45,7 @@ def query(db, cookie) -> Query:
             "cookie": cookie,
             "cache": {},
             "sqlalchemy_loader": StrawberrySQLAlchemyLoader(bind=db),
+            "loaders": Loaders(db),
         }
         result = await s.schema.execute(
             q,
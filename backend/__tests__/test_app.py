@@ -1,10 +1,14 @@
+import hashlib
 import os
 
 import pytest
 from flask import Flask
 from flask.testing import FlaskClient
+from sqlalchemy import Engine, event
+from sqlalchemy.orm import Session
 
-from ..app import create_app
+from .. import models as m
+from ..app import create_app, create_async_db_engine, create_db_engine
 
 
 @pytest.fixture
@@ -22,6 +26,53 @@ def client(app: Flask):
     return app.test_client()
 
 
+@pytest.fixture
+def db_client(tmp_path):
+    # a file, so that the async view's thread can share the connection
+    app = create_app(
+        test_config={
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/test.sqlite",
+            "SECRET_KEY": "test",
+        }
+    )
+    engine = create_db_engine(app.config)
+    m.Base.metadata.create_all(engine)
+    m.populate_example_data(Session(engine))
+    return app.test_client()
+
+
+def test_db_engine(app: Flask, tmp_path):
+    engine = create_db_engine(
+        {
+            **app.config,
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/test.sqlite",
+            "SQLALCHEMY_POOL_SIZE": 3,
+        }
+    )
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+    assert engine.pool.size() == 3  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_async_db_engine(app: Flask, tmp_path):
+    engine = create_async_db_engine(
+        {**app.config, "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/test.sqlite"}
+    )
+    assert engine.url.drivername == "sqlite+aiosqlite"
+    async with engine.connect() as conn:
+        result = await conn.exec_driver_sql("PRAGMA journal_mode")
+        assert result.scalar() == "wal"
+    await engine.dispose()
+
+    with pytest.raises(ValueError, match="No async driver for postgresql"):
+        create_async_db_engine(
+            {**app.config, "SQLALCHEMY_DATABASE_URI": "postgresql://localhost/db"}
+        )
+
+
 def test_graphql(client: FlaskClient):
     response = client.post(
         "/graphql", json={"query": "{ __schema { types { name } } }"}
@@ -31,6 +82,71 @@ def test_graphql(client: FlaskClient):
     assert response.json["data"]["__schema"]["types"][0]["name"] == "Query"
 
 
+def test_graphql_persisted_query(db_client: FlaskClient):
+    client = db_client
+    q = "query q { surveys { name } }"
+    extensions = {
+        "persistedQuery": {
+            "version": 1,
+            "sha256Hash": hashlib.sha256(q.encode()).hexdigest(),
+        }
+    }
+
+    response = client.post("/graphql", json={"extensions": extensions})
+    assert response.status_code == 200
+    assert response.json["errors"][0]["message"] == "PersistedQueryNotFound"
+    assert (
+        response.json["errors"][0]["extensions"]["code"] == "PERSISTED_QUERY_NOT_FOUND"
+    )
+
+    response = client.post("/graphql", json={"query": q, "extensions": extensions})
+    assert response.json is not None
+    assert "errors" not in response.json
+
+    response = client.post("/graphql", json={"extensions": extensions})
+    assert response.json is not None
+    assert "errors" not in response.json
+    assert response.json["data"]["surveys"] is not None
+
+
+def test_db_is_lazy(tmp_path):
+    # a database that can't be opened only breaks the routes that use it
+    app = create_app(
+        test_config={"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/no/db.sqlite"}
+    )
+    client = app.test_client()
+    assert client.get("/heartbeat").status_code == 200
+    response = client.post("/graphql", json={"query": "{ surveys { name } }"})
+    assert response.status_code == 500
+
+
+def test_db_commits_writes_only(db_client: FlaskClient):
+    client = db_client
+    commits = []
+
+    def on_commit(conn):
+        commits.append(conn)
+
+    event.listen(Engine, "commit", on_commit)
+    try:
+        client.post("/graphql", json={"query": "{ surveys { name } }"})
+        assert commits == []
+
+        response = client.post(
+            "/graphql",
+            json={
+                "query": 'mutation { createUser(username: "Zed", password1: "x", password2: "x", email: "z@example.com") { __typename } }'
+            },
+        )
+        assert response.json["data"]["createUser"]["__typename"] == "User"
+        assert len(commits) == 1
+    finally:
+        event.remove(Engine, "commit", on_commit)
+
+    with Session(create_db_engine(client.application.config)) as db:
+        assert db.query(m.User).filter(m.User.username == "Zed").one()
+
+
 def test_static(client: FlaskClient):
     if not os.path.exists("./frontend/dist/favicon.svg"):
         pytest.skip("frontend not built")
@@ -48,6 +164,37 @@ def test_static(client: FlaskClient):
     assert response.content_type == "text/html; charset=utf-8"
 
 
+def test_heartbeat(client: FlaskClient):
+    response = client.get("/heartbeat")
+    assert response.status_code == 200
+    assert response.json["status"] == "healthy"
+    assert set(response.json["comparison_cache"]) == {"hits", "misses"}
+
+
+def test_ready(db_client: FlaskClient, tmp_path):
+    response = db_client.get("/ready")
+    assert response.status_code == 200
+    assert response.json["status"] == "healthy"
+
+    app = create_app(
+        test_config={"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/no/db.sqlite"}
+    )
+    response = app.test_client().get("/ready")
+    assert response.status_code == 503
+    assert response.json["status"] == "unhealthy"
+
+
+def test_metrics(db_client: FlaskClient):
+    db_client.post("/graphql", json={"query": "query q { surveys { name } }"})
+    response = db_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    assert 'graphql_operation_seconds_count{operation="q",type="query"}' in (
+        response.text
+    )
+    assert "db_pool_checked_out 0\n" in response.text
+
+
 def test_webapp(client: FlaskClient):
     if not os.path.exists("./frontend/dist/index.html"):
         pytest.skip("frontend not built")
@@ -0,0 +1,180 @@
+import hashlib
+
+import pytest
+from sqlalchemy import Engine, event, select
+from sqlalchemy.orm import Session
+from starlette.testclient import TestClient
+
+from .. import models as m
+from ..app import create_db_engine
+from ..asgi import create_asgi_app
+
+LOGIN = """
+    mutation m($username: String!, $password: String!) {
+        login(username: $username, password: $password) { username }
+    }
+"""
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(m, "SECURE", False)
+    app = create_asgi_app(
+        test_config={
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/test.sqlite",
+            "SECRET_KEY": "test",
+            "GRAPHQL_PROFILE": "extensions",
+        }
+    )
+    engine = create_db_engine(
+        {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/test.sqlite",
+            "SQLALCHEMY_POOL_SIZE": 1,
+            "SQLALCHEMY_MAX_OVERFLOW": 0,
+        }
+    )
+    m.Base.metadata.create_all(engine)
+    m.populate_example_data(Session(engine))
+    # the session cookie is Secure, so it's only sent back over https
+    with TestClient(app, base_url="https://testserver") as client:
+        yield client
+
+
+def graphql(client: TestClient, query: str, **variables) -> dict:
+    response = client.post("/graphql", json={"query": query, "variables": variables})
+    assert response.status_code == 200
+    assert "errors" not in response.json(), response.json()["errors"]
+    return response.json()["data"]
+
+
+def test_asgi_cookie_session(client: TestClient):
+    assert graphql(client, "{ user { username } }") == {"user": None}
+
+    response = client.post(
+        "/graphql",
+        json={
+            "query": LOGIN,
+            "variables": {"username": "alice", "password": "alicepass"},
+        },
+    )
+    cookie = response.headers["set-cookie"]
+    assert cookie.startswith("session=")
+    assert "Secure" in cookie and "HttpOnly" in cookie and "SameSite=none" in cookie
+    assert "expires=" in cookie  # login makes the session permanent
+    assert response.headers["vary"] == "Cookie"
+    assert graphql(client, "{ user { username } }") == {"user": {"username": "Alice"}}
+
+    response = client.post("/graphql", json={"query": "mutation { logout }"})
+    assert response.headers["set-cookie"].startswith("session=")
+    assert graphql(client, "{ user { username } }") == {"user": None}
+
+
+def test_asgi_resolvers(client: TestClient):
+    graphql(client, LOGIN, username="alice", password="alicepass")
+    data = graphql(
+        client,
+        """
+        query q {
+            survey(surveyId: 1) {
+                name
+                questions { text }
+                stats { friendResponses otherResponses unansweredQuestions }
+                myResponse { id }
+                responses {
+                    id
+                    owner { username }
+                }
+            }
+            user { friends { username } }
+        }
+        """,
+    )
+    survey = data["survey"]
+    assert survey["questions"]
+    assert survey["stats"]["otherResponses"] >= 0
+    assert survey["myResponse"]["id"]
+
+    their = next(
+        r for r in survey["responses"] if r["id"] != survey["myResponse"]["id"]
+    )
+    data = graphql(
+        client,
+        "query q($id: Int!) { response(responseId: $id) { comparison { text } } }",
+        id=int(their["id"]),
+    )
+    assert data["response"]["comparison"]
+
+
+def test_asgi_profile(client: TestClient):
+    response = client.post("/graphql", json={"query": "query q { surveys { name } }"})
+    extensions = response.json()["extensions"]
+    assert extensions["queryCount"] == 1
+    [q] = extensions["sqlProfile"]["queries"]
+    assert q["path"] == "surveys"
+
+
+def test_asgi_commits_writes_only(client: TestClient, tmp_path):
+    commits = []
+
+    def on_commit(conn):
+        commits.append(conn)
+
+    event.listen(Engine, "commit", on_commit)
+    try:
+        graphql(client, "{ surveys { name } }")
+        assert commits == []
+        data = graphql(
+            client,
+            'mutation { createUser(username: "Zed", password1: "x", password2: "x", email: "z@example.com") { username } }',
+        )
+        assert data["createUser"]["username"] == "Zed"
+        assert len(commits) == 1
+    finally:
+        event.remove(Engine, "commit", on_commit)
+
+    engine = create_db_engine(
+        {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/test.sqlite",
+            "SQLALCHEMY_POOL_SIZE": 1,
+            "SQLALCHEMY_MAX_OVERFLOW": 0,
+        }
+    )
+    with Session(engine) as db:
+        assert db.scalars(select(m.User).where(m.User.username == "Zed")).one()
+
+
+def test_asgi_errors_roll_back(client: TestClient):
+    response = client.post(
+        "/graphql", json={"query": "query q { survey(surveyId: 999) { name } }"}
+    )
+    assert response.json()["errors"][0]["message"]
+    # the connection went back to the pool
+    assert graphql(client, "{ surveys { name } }")["surveys"]
+
+
+def test_asgi_persisted_query(client: TestClient):
+    q = "query q { surveys { name } }"
+    extensions = {
+        "persistedQuery": {
+            "version": 1,
+            "sha256Hash": hashlib.sha256(q.encode()).hexdigest(),
+        }
+    }
+    response = client.post("/graphql", json={"extensions": extensions})
+    assert response.json()["errors"][0]["message"] == "PersistedQueryNotFound"
+    client.post("/graphql", json={"query": q, "extensions": extensions})
+    response = client.post("/graphql", json={"extensions": extensions})
+    assert response.json()["data"]["surveys"]
+
+
+def test_asgi_flask_routes(client: TestClient):
+    response = client.get("/heartbeat")
+    assert response.status_code == 200
+    assert response.json()["status"] == "healthy"
+
+    response = client.get("/ready")
+    assert response.status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "db_pool_size 5\n" in response.text
@@ -0,0 +1,45 @@
+import types
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import MissingGreenlet
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+
+from ..async_db import is_async, run, uses_db
+
+
+@pytest.mark.asyncio
+async def test_run():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    # async_session() only finds the AsyncSession while it's alive
+    adb = AsyncSession(engine)
+    db = adb.sync_session
+    assert is_async(db)
+    with pytest.raises(MissingGreenlet):
+        db.scalar(text("SELECT 1"))
+    assert await run(db, db.scalar, text("SELECT :x"), {"x": 2}) == 2
+    await adb.close()
+    await engine.dispose()
+
+    # plain sessions are called directly
+    db = Session(create_engine("sqlite://"))
+    assert not is_async(db)
+    assert await run(db, db.scalar, text("SELECT 3")) == 3
+
+
+@pytest.mark.asyncio
+async def test_uses_db():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    adb = AsyncSession(engine)
+    db = adb.sync_session
+    info = types.SimpleNamespace(context={"db": db})
+
+    @uses_db
+    def resolver(root, info, x: int) -> int:
+        return info.context["db"].scalar(text("SELECT :x"), {"x": x})
+
+    assert resolver.__name__ == "resolver"
+    assert await resolver(None, info=info, x=4) == 4
+    await adb.close()
+    await engine.dispose()
@@ -0,0 +1,34 @@
+from ..cache import TTLCache
+
+
+def test_ttl_cache_expires():
+    now = 0.0
+    cache = TTLCache[str, int](max_size=10, ttl=5, clock=lambda: now)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert "a" in cache
+    now = 5.0
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_lru():
+    cache = TTLCache[str, int](max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+    assert cache.pop("a") == 1
+    assert cache.pop("a") is None
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_ttl_cache_disabled():
+    cache = TTLCache[str, int](max_size=0, ttl=60)
+    cache.set("a", 1)
+    assert cache.get("a") is None
@@ -0,0 +1,103 @@
+import random
+
+from .. import compare
+from .. import models as m
+
+
+def naive_compare(
+    questions: list[m.Question],
+    mine: dict[int, m.Answer],
+    theirs: dict[int, m.Answer],
+) -> list[compare.Match]:
+    matches = []
+    for q in questions:
+        ma = mine.get(q.id)
+        ta = theirs.get(q.id)
+        if ma and ta:
+            if q.flip:
+                if (ma.value, ta.flip) in compare.visible_combos:
+                    matches.append(
+                        compare.Match(
+                            q.section, q.order, q.text, q.flip, ma.value, ta.flip
+                        )
+                    )
+                if (ma.flip, ta.value) in compare.visible_combos:
+                    matches.append(
+                        compare.Match(
+                            q.section, q.order, q.flip, q.text, ma.flip, ta.value
+                        )
+                    )
+            elif (ma.value, ta.value) in compare.visible_combos:
+                matches.append(
+                    compare.Match(q.section, q.order, q.text, None, ma.value, ta.value)
+                )
+    return matches
+
+
+def random_answers(questions: list[m.Question], rng: random.Random):
+    return {
+        q.id: m.Answer(
+            question_id=q.id,
+            value=rng.choice(list(m.WWW)),
+            flip=rng.choice(list(m.WWW)),
+        )
+        for q in questions
+        if rng.random() > 0.2
+    }
+
+
+def test_compare_matches_naive():
+    rng = random.Random(1234)
+    questions = [
+        m.Question(
+            id=n * 3,
+            section=f"s{n % 7}",
+            order=float(n),
+            text=f"q{n}",
+            flip=rng.choice([None, "", f"flip{n}"]),
+        )
+        for n in range(500)
+    ]
+    ids = [q.id for q in questions]
+    for _ in range(20):
+        mine = random_answers(questions, rng)
+        theirs = random_answers(questions, rng)
+        assert compare.compare(
+            questions,
+            compare.encode(ids, mine),
+            compare.encode(ids, theirs),
+        ) == naive_compare(questions, mine, theirs)
+
+
+def test_compare_empty():
+    assert compare.compare([], compare.encode([], {}), compare.encode([], {})) == []
+
+
+def test_scorer_counts_matches():
+    rng = random.Random(5678)
+    questions = [
+        m.Question(id=n, text=f"q{n}", flip=rng.choice([None, "", f"flip{n}"]))
+        for n in range(300)
+    ]
+    ids = [q.id for q in questions]
+    mine = compare.encode(ids, random_answers(questions, rng))
+    scorer = compare.Scorer(questions, mine)
+    for _ in range(20):
+        theirs = compare.encode(ids, random_answers(questions, rng))
+        assert scorer.score(theirs) == len(compare.compare(questions, mine, theirs))
+
+
+def test_pack_round_trip():
+    rng = random.Random(91011)
+    for n in [0, 1, 2, 7, 300]:
+        questions = [m.Question(id=q, text=f"q{q}") for q in range(n)]
+        ids = [q.id for q in questions]
+        answers = compare.encode(ids, random_answers(questions, rng))
+        bits = compare.pack(answers)
+        assert len(bits) == (n + 1) // 2
+        assert compare.unpack(bits, n) == answers
+        # questions added since the answers were packed are unanswered
+        more = compare.unpack(bits, n + 3)
+        assert more.value[:n] == answers.value and more.value[n:] == bytes(3)
+        assert more.flip[:n] == answers.flip and more.flip[n:] == bytes(3)
+    assert compare.unpack(None, 2) == compare.Vector(bytes(2), bytes(2))
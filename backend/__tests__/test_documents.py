@@ -0,0 +1,80 @@
+# mypy: disable-error-code="index"
+
+import hashlib
+import typing as t
+
+import pytest
+from strawberry.http import GraphQLRequestData
+
+from .. import documents
+from .conftest import Query
+
+
+@pytest.mark.asyncio
+async def test_document_cache(query: Query):
+    # functools.lru_cache wrappers
+    parse: t.Any = documents.parser_cache().cached_parse_document
+    validate: t.Any = documents.validation_cache().cached_validate_document
+    parse.cache_clear()
+    validate.cache_clear()
+
+    q = "query q { surveys { name } }"
+    first = await query(q)
+    second = await query(q)
+    assert first.data == second.data
+    assert parse.cache_info().misses == 1
+    assert parse.cache_info().hits == 1
+    assert validate.cache_info().misses == 1
+    assert validate.cache_info().hits == 1
+
+    # invalid documents keep failing validation
+    bad = "query q { surveys { nope } }"
+    error = "Cannot query field 'nope' on type 'Survey'. Did you mean 'name'?"
+    await query(bad, error=error)
+    await query(bad, error=error)
+    assert validate.cache_info().misses == 2
+
+
+def request(query: str | None, sha: str | None, version: int = 1):
+    return GraphQLRequestData(
+        query=query,
+        variables=None,
+        operation_name=None,
+        extensions={"persistedQuery": {"version": version, "sha256Hash": sha}},
+    )
+
+
+def test_persisted_query():
+    documents.persisted_queries.clear()
+    q = "query q { surveys { name } }"
+    sha = hashlib.sha256(q.encode()).hexdigest()
+
+    with pytest.raises(documents.PersistedQueryNotFound):
+        documents.resolve_persisted_query(request(None, sha))
+
+    data = request(q, sha)
+    documents.resolve_persisted_query(data)
+    assert data.query == q
+
+    data = request(None, sha)
+    documents.resolve_persisted_query(data)
+    assert data.query == q
+
+
+def test_persisted_query_invalid():
+    q = "query q { surveys { name } }"
+    sha = hashlib.sha256(q.encode()).hexdigest()
+    for data, error in [
+        (request(q, "0" * 64), "Provided sha does not match query"),
+        (request(q, "nope"), "Invalid persisted query hash"),
+        (request(q, sha, version=2), "Unsupported persisted query version"),
+    ]:
+        with pytest.raises(documents.GraphQLError, match=error):
+            documents.resolve_persisted_query(data)
+
+    # requests without the extension are left alone
+    data = GraphQLRequestData(
+        query=q, variables=None, operation_name=None, extensions=None
+    )
+    documents.resolve_persisted_query(data)
+    assert data.query == q
@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+from sqlalchemy import Engine, update
+from sqlalchemy.orm import Session
+
+from .. import models as m
+from ..app import create_app, create_db_engine
+from ..health import HealthCheck, Thresholds
+
+
+@pytest.fixture
+def engine(tmp_path) -> Engine:
+    app = create_app(
+        test_config={"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/test.sqlite"}
+    )
+    engine = create_db_engine(
+        {**app.config, "SQLALCHEMY_POOL_SIZE": 1, "SQLALCHEMY_MAX_OVERFLOW": 1}
+    )
+    m.Base.metadata.create_all(engine)
+    m.populate_example_data(Session(engine))
+    return engine
+
+
+def test_healthy(engine: Engine):
+    result = HealthCheck(engine, 1, Thresholds()).check()
+    assert result["status"] == "healthy"
+    assert result["checks"]["db"]["ms"] >= 0
+    assert result["checks"]["pool"] == {
+        "status": "healthy",
+        "checked_out": 0,
+        "capacity": 2,
+        "saturation": 0.0,
+    }
+    assert result["checks"]["wal"]["status"] == "healthy"
+
+
+def test_cached(engine: Engine, monkeypatch):
+    check = HealthCheck(engine, 1, Thresholds(cache_seconds=60))
+    first = check.check()
+    monkeypatch.setattr(check, "_probe", lambda: pytest.fail("not cached"))
+    second = check.check()
+    assert second["checks"] == first["checks"]
+    assert second["age"] >= first["age"]
+
+
+def test_timeout(engine: Engine, monkeypatch):
+    release = threading.Event()
+    check = HealthCheck(engine, 1, Thresholds(timeout=0.01, cache_seconds=0))
+    monkeypatch.setattr(check, "_round_trip", lambda: release.wait(5) and 0.0)
+    try:
+        result = check.check()
+        assert result["status"] == "unhealthy"
+        assert result["checks"]["db"] == {"status": "unhealthy", "error": "timeout"}
+        # a stuck probe isn't started again
+        running = check._running
+        check.check()
+        assert check._running is running
+    finally:
+        release.set()
+
+
+def test_slow(engine: Engine):
+    result = HealthCheck(engine, 1, Thresholds(slow_ms=-1)).check()
+    assert result["status"] == "degraded"
+    assert result["checks"]["db"]["status"] == "degraded"
+
+
+def test_db_error(tmp_path):
+    app = create_app(
+        test_config={"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/no/db.sqlite"}
+    )
+    engine = create_db_engine(app.config)
+    result = HealthCheck(engine, 0, Thresholds()).check()
+    assert result["status"] == "unhealthy"
+    assert "unable to open database file" in result["checks"]["db"]["error"]
+
+
+def test_pool_saturated(engine: Engine):
+    check = HealthCheck(engine, 1, Thresholds(timeout=0.01, cache_seconds=0))
+    with engine.connect():
+        assert check._check_pool()["status"] == "healthy"
+        with engine.connect():
+            assert check._check_pool()["status"] == "unhealthy"
+    check = HealthCheck(engine, 1, Thresholds(pool_degraded=0.5))
+    with engine.connect():
+        assert check._check_pool()["status"] == "degraded"
+
+
+def test_wal(engine: Engine):
+    with engine.begin() as conn:
+        conn.execute(update(m.User).values(email="x"))
+    result = HealthCheck(engine, 1, Thresholds(max_wal_bytes=0)).check()
+    assert result["checks"]["wal"]["bytes"] > 0
+    assert result["checks"]["wal"]["status"] == "degraded"
+    assert result["status"] == "degraded"
+
+
+def test_in_memory():
+    app = create_app(test_config={"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    engine = create_db_engine(app.config)
+    m.Base.metadata.create_all(engine)
+    result = HealthCheck(engine, 0, Thresholds()).check()
+    assert set(result["checks"]) == {"db"}
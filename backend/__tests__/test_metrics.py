@@ -0,0 +1,128 @@
+# mypy: disable-error-code="index"
+
+import json
+import os
+import subprocess
+import time
+
+import pytest
+
+from .. import metrics
+from .conftest import Login, Query
+
+
+@pytest.fixture
+def metrics_dir(tmp_path):
+    metrics.reset()
+    metrics.configure(str(tmp_path))
+    yield tmp_path
+    metrics.configure(None)
+    metrics.reset()
+
+
+def test_histogram(metrics_dir):
+    metrics.operation_seconds.observe((("operation", "q"), ("type", "query")), 0.003)
+    metrics.operation_seconds.observe((("operation", "q"), ("type", "query")), 10)
+    text = metrics.render()
+    assert "# TYPE graphql_operation_seconds histogram" in text
+    labels = 'operation="q",type="query"'
+    assert f'graphql_operation_seconds_bucket{{{labels},le="0.0025"}} 0' in text
+    assert f'graphql_operation_seconds_bucket{{{labels},le="0.005"}} 1' in text
+    assert f'graphql_operation_seconds_bucket{{{labels},le="5.0"}} 1' in text
+    assert f'graphql_operation_seconds_bucket{{{labels},le="+Inf"}} 2' in text
+    assert f"graphql_operation_seconds_sum{{{labels}}} 10.003" in text
+    assert f"graphql_operation_seconds_count{{{labels}}} 2" in text
+    assert "comparison_cache_hits_total " in text
+
+
+def test_histogram_labels_bounded(metrics_dir, monkeypatch):
+    monkeypatch.setattr(metrics, "MAX_LABELS", 2)
+    for name in ["a", "b", "c", "d"]:
+        metrics.operation_seconds.observe((("operation", name),), 0.1)
+    text = metrics.render()
+    assert 'graphql_operation_seconds_count{operation="a"} 1' in text
+    assert 'graphql_operation_seconds_count{operation="c"}' not in text
+    assert 'graphql_operation_seconds_count{operation="other"} 2' in text
+
+
+def test_label_escaping():
+    assert metrics._format_labels([("op", 'a"b\\c\nd')]) == '{op="a\\"b\\\\c\\nd"}'
+
+
+def test_merge_workers(metrics_dir):
+    metrics.operation_seconds.observe((("operation", "q"),), 0.003)
+    metrics.write_snapshot()
+
+    # another worker, one that's stopped writing snapshots, and one that's
+    # exited
+    other = metrics.snapshot()
+    other["pid"] = os.getppid()
+    other["samples"] = [
+        ["db_pool_checked_out", "gauge", [], 2],
+        ["comparison_cache_hits_total", "counter", [], 5],
+    ]
+    (metrics_dir / "other.json").write_text(json.dumps(other))
+    stale = {**other, "time": time.time() - metrics.STALE_AFTER - 1}
+    (metrics_dir / "stale.json").write_text(json.dumps(stale))
+    exited = subprocess.Popen(["true"])
+    exited.wait()
+    (metrics_dir / "exited.json").write_text(json.dumps({**other, "pid": exited.pid}))
+
+    def check(text: str) -> None:
+        # histograms and counters from everybody, gauges only from live
+        # workers
+        assert 'graphql_operation_seconds_count{operation="q"} 4' in text
+        assert "db_pool_checked_out 2\n" in text
+        hits = metrics.compare.cache_stats.hits + 5 + 5 + 5
+        assert f"comparison_cache_hits_total {hits}\n" in text
+
+    check(metrics.render())
+    # the exited worker's snapshot has been folded into the totals
+    assert not (metrics_dir / "exited.json").exists()
+    assert (metrics_dir / metrics.TOTALS_FILE).exists()
+    check(metrics.render())
+
+    # and so have any more, once they exit
+    (metrics_dir / "stale.json").write_text(json.dumps({**stale, "pid": exited.pid}))
+    check(metrics.render())
+    assert not (metrics_dir / "stale.json").exists()
+
+
+def test_process_id(metrics_dir):
+    # snapshots aren't named after pids, which get reused
+    metrics.write_snapshot()
+    (path,) = metrics_dir.glob("*.json")
+    assert path.stem != str(os.getpid())
+
+    # and forked workers don't share one
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        os.write(write, metrics._process_id.encode())
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read, 100).decode() not in ("", metrics._process_id)
+
+
+@pytest.mark.asyncio
+async def test_extension(metrics_dir, query: Query, login: Login):
+    await login("Alice")
+    await query(
+        """
+        query q {
+            survey(surveyId: 1) {
+                name
+                responses { id }
+                stats { friendResponses }
+            }
+        }
+        """
+    )
+    fields = {dict(labels)["field"] for labels in metrics.resolver_seconds.series}
+    assert {"Query.survey", "Survey.responses", "Survey.stats"} <= fields
+    # scalars aren't timed
+    assert "Survey.name" not in fields
+    ops = {dict(labels)["operation"] for labels in metrics.operation_seconds.series}
+    assert {"m", "q"} <= ops
+    # the first operation wrote a snapshot
+    assert list(metrics_dir.glob("*.json"))
@@ -0,0 +1,114 @@
+import asyncio
+import threading
+
+import pytest
+
+from .. import models as m
+from .. import passwords
+
+
+def test_hash_and_verify():
+    hashed = passwords.hash_password("hunter2")
+    assert hashed != "hunter2"
+    assert passwords.verify_password("hunter2", hashed)
+    assert not passwords.verify_password("hunter3", hashed)
+
+
+@pytest.mark.asyncio
+async def test_hash_and_verify_async():
+    hashed = await passwords.hash_password_async("hunter2")
+    assert await passwords.verify_password_async("hunter2", hashed)
+    assert not await passwords.verify_password_async("hunter3", hashed)
+
+
+@pytest.mark.asyncio
+async def test_hashing_is_bounded(monkeypatch):
+    running = 0
+    most = 0
+    lock = threading.Lock()
+
+    def slow_hash(password: str) -> str:
+        nonlocal running, most
+        with lock:
+            running += 1
+            most = max(most, running)
+        threading.Event().wait(0.05)
+        with lock:
+            running -= 1
+        return password
+
+    monkeypatch.setattr(passwords, "hash_password", slow_hash)
+    passwords.configure(2)
+    try:
+        results = await asyncio.gather(
+            *(passwords.hash_password_async(str(n)) for n in range(6))
+        )
+    finally:
+        passwords.configure(passwords.DEFAULT_WORKERS)
+    assert results == [str(n) for n in range(6)]
+    assert most == 2
+
+
+def test_configure_invalid():
+    with pytest.raises(ValueError):
+        passwords.configure(0)
+
+
+@pytest.mark.asyncio
+async def test_user_password_insecure(db):
+    user = m.User("Zed")
+    await user.set_password_async("zedpass")
+    assert user.check_password("zedpass")
+    assert await user.check_password_async("zedpass")
+    assert not await user.check_password_async("wrong")
+
+
+def test_verify_not_bcrypt():
+    assert not passwords.verify_password("hunter2", "hunter2")
+
+
+def test_needs_rehash():
+    passwords.configure(rounds=4)
+    try:
+        assert not passwords.needs_rehash(passwords.hash_password("x"))
+        assert passwords.needs_rehash(
+            passwords.hash_password("x").replace("$2b$", "$2a$")
+        )
+        assert passwords.needs_rehash("$2b$05$" + "x" * 53)
+        assert passwords.needs_rehash("plaintext")
+    finally:
+        passwords.configure()
+
+
+def test_configure_invalid_rounds():
+    with pytest.raises(ValueError):
+        passwords.configure(rounds=3)
+
+
+@pytest.mark.asyncio
+async def test_check_password_cached(monkeypatch):
+    passwords.configure(rounds=4)
+    hashed = passwords.hash_password("hunter2")
+    calls = []
+
+    def counting_verify(password: str, hashed: str) -> bool:
+        calls.append(password)
+        return password == "hunter2"
+
+    monkeypatch.setattr(passwords, "verify_password", counting_verify)
+    try:
+        # failures are never cached
+        assert not await passwords.check_password_async(1, "wrong", hashed)
+        assert not await passwords.check_password_async(1, "wrong", hashed)
+        assert len(calls) == 2
+
+        # successes are, but only for the same user, password and hash
+        assert await passwords.check_password_async(1, "hunter2", hashed)
+        assert await passwords.check_password_async(1, "hunter2", hashed)
+        assert len(calls) == 3
+        assert await passwords.check_password_async(2, "hunter2", hashed)
+        assert len(calls) == 4
+        assert await passwords.check_password_async(1, "hunter2", hashed + "x")
+        assert len(calls) == 5
+    finally:
+        passwords.configure()
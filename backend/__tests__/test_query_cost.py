@@ -0,0 +1,125 @@
+# mypy: disable-error-code="index"
+
+import pytest
+from graphql import FragmentDefinitionNode, parse
+from graphql.utilities import get_operation_ast
+
+from .. import query_cost
+from .. import schema as s
+from .conftest import Query
+
+
+def cost(q: str, limits: query_cost.Limits | None = None, **variables) -> int:
+    document = parse(q)
+    operation = get_operation_ast(document)
+    assert operation
+    fragments = {
+        d.name.value: d
+        for d in document.definitions
+        if isinstance(d, FragmentDefinitionNode)
+    }
+    return query_cost.estimate(
+        s.schema._schema, operation, fragments, variables, limits
+    )
+
+
+def test_estimate():
+    limits = query_cost.Limits()
+    # scalars are free, objects are one query each
+    assert cost("query q { __typename }") == 0
+    assert cost("query q { survey(surveyId: 1) { name } }") == 1
+    assert cost("query q { survey(surveyId: 1) { owner { username } } }") == 2
+    # lists multiply everything inside them
+    assert (
+        cost("query q { surveys { owner { username } } }")
+        == 1 + limits.default_list_size
+    )
+    assert (
+        cost("query q { survey(surveyId: 1) { responses { owner { username } } } }")
+        == 1 + 1 + limits.list_sizes["Survey.responses"]
+    )
+    # expensive fields cost more
+    assert (
+        cost("query q { response(responseId: 1) { comparison { text } } }")
+        == 1 + limits.field_costs["Response.comparison"]
+    )
+    # introspection is free
+    assert cost("query q { __schema { types { name } } }") == 0
+
+
+def test_estimate_connection():
+    q = """
+        query q($first: Int) {
+            surveysConnection(first: $first) {
+                edges { node { owner { username } } }
+                pageInfo { hasNextPage }
+            }
+        }
+    """
+    limits = query_cost.Limits()
+    # connection + page size * (edges + node + owner), + pageInfo
+    assert cost(q, first=5) == 1 + 5 * (1 + 1 + 1 + 1)
+    assert cost(q) == 1 + limits.default_page_size * 4
+    assert (
+        cost('query q { surveysConnection(after: "x", first: 2) { edges { cursor } } }')
+        == 1 + 2 * 1
+    )
+    assert (
+        cost("query q { surveysConnection { edges { cursor } } }")
+        == 1 + limits.default_page_size
+    )
+
+    # paginate() refuses or caps these, so they can't make a query look cheap
+    assert limits.max_page_size == s.MAX_PAGE_SIZE
+    assert cost(q, first=-100) == 1 + 1 * 4
+    assert cost(q, first=0) == 1 + 1 * 4
+    assert cost(q, first=10_000) == 1 + limits.max_page_size * 4
+
+
+def test_estimate_fragments():
+    q = """
+        query q {
+            survey(surveyId: 1) {
+                ...S
+                ... on Survey { owner { username } }
+                ... { owner { username } }
+            }
+        }
+        fragment S on Survey { owner { username } }
+    """
+    assert cost(q) == 1 + 1 + 1 + 1
+    # we don't have subscriptions
+    assert cost("subscription s { x }") == 0
+
+
+def test_estimate_depth():
+    q = "query q { user { " + "friends { " * 10 + "username" + " }" * 11 + " }"
+    with pytest.raises(query_cost.QueryTooExpensive, match="too deeply nested"):
+        cost(q)
+
+
+def test_configure():
+    try:
+        query_cost.configure(max_cost=5, field_costs={"Survey.owner": 3})
+        assert query_cost.LIMITS.max_cost == 5
+        assert query_cost.LIMITS.field_costs["Survey.owner"] == 3
+        assert "Response.comparison" in query_cost.LIMITS.field_costs
+        assert cost("query q { survey(surveyId: 1) { owner { username } } }") == 4
+    finally:
+        query_cost.configure()
+
+
+@pytest.mark.asyncio
+async def test_too_expensive(query: Query):
+    q = "query q { surveys { responses { comparison { text } } } }"
+    try:
+        query_cost.configure(max_cost=100)
+        result = await query(q, error="Query is too expensive (cost 10021, max 100)")
+        assert result.data is None
+        # nothing was run
+        assert result.extensions["queryCount"] == 0
+    finally:
+        query_cost.configure()
+
+    result = await query("query q { surveys { name } }")
+    assert result.extensions["queryCost"] == 1
@@ -0,0 +1,119 @@
+# mypy: disable-error-code="index"
+
+import json
+import logging
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .. import models as m
+from .. import query_counter
+from .conftest import Login, Query
+
+# the same statement from three different fields
+REPEATED = """
+    query q {
+        a: survey(surveyId: 1) { name }
+        b: survey(surveyId: 1) { name }
+        c: survey(surveyId: 1) { name }
+    }
+"""
+
+
+@pytest.mark.asyncio
+async def test_profile_extensions(query: Query, login: Login):
+    await login("Alice")
+    query_counter.configure(mode="extensions", n_plus_one_threshold=3)
+    try:
+        result = await query(REPEATED)
+    finally:
+        query_counter.configure()
+
+    profile = result.extensions["sqlProfile"]
+    assert result.extensions["queryCount"] == len(profile["queries"]) == 3
+    assert [q["path"] for q in profile["queries"]] == ["a", "b", "c"]
+    assert all(q["ms"] >= 0 for q in profile["queries"])
+    assert [q["rows"] for q in profile["queries"]] == [1, 1, 1]
+    assert profile["ms"] >= 0
+    [suspect] = profile["nPlusOne"]
+    assert suspect["count"] == 3
+    assert suspect["paths"] == ["a", "b", "c"]
+
+
+@pytest.mark.asyncio
+async def test_profile_rows(db: Session, query: Query, login: Login):
+    await login("Alice")
+    surveys = db.scalars(select(m.Survey)).all()
+    result = await query("query q { surveys { name } }")
+    [read] = result.extensions["sqlProfile"]["queries"]
+    assert read["rows"] == len(surveys)
+
+    # writes report how many rows they changed
+    result = await query('mutation m { removeFriend(username: "Bob") { username } }')
+    [delete] = [
+        q
+        for q in result.extensions["sqlProfile"]["queries"]
+        if q["statement"].startswith("DELETE FROM friendship")
+    ]
+    assert delete["rows"] == 1
+
+
+@pytest.mark.asyncio
+async def test_profile_paths(query: Query, login: Login):
+    await login("Alice")
+    query_counter.configure(mode="extensions")
+    try:
+        result = await query(
+            """
+            query q {
+                survey(surveyId: 1) {
+                    responses { owner { username } }
+                    myResponse { id }
+                }
+            }
+            """
+        )
+    finally:
+        query_counter.configure()
+    paths = {q["path"] for q in result.extensions["sqlProfile"]["queries"]}
+    # list indexes are collapsed, async resolvers are tracked too
+    assert {"survey", "survey.responses", "survey.myResponse"} <= paths
+    assert result.extensions["sqlProfile"]["nPlusOne"] == []
+
+
+@pytest.mark.asyncio
+async def test_profile_log(query: Query, login: Login, caplog):
+    await login("Alice")
+    caplog.set_level(logging.DEBUG, logger=query_counter.__name__)
+    query_counter.configure(mode="log", n_plus_one_threshold=3)
+    try:
+        result = await query(REPEATED)
+        await query("query q { survey(surveyId: 1) { name } }")
+        caplog.set_level(logging.INFO, logger=query_counter.__name__)
+        await query("query q { survey(surveyId: 1) { name } }")
+    finally:
+        query_counter.configure()
+
+    assert result.extensions is not None
+    assert "sqlProfile" not in result.extensions
+    [slow, fast] = caplog.records
+    assert slow.levelno == logging.WARNING
+    record = json.loads(slow.getMessage())
+    assert record["operation"] == "q"
+    assert record["queryCount"] == 3
+    assert record["nPlusOne"][0]["count"] == 3
+    assert len(record["slowest"]) == 3
+    assert fast.levelno == logging.DEBUG
+
+
+@pytest.mark.asyncio
+async def test_profile_off(query: Query):
+    query_counter.configure(mode=None)
+    try:
+        result = await query("query q { survey(surveyId: 1) { name } }")
+    finally:
+        query_counter.configure()
+    assert result.extensions is not None
+    assert result.extensions["queryCount"] == 1
+    assert "sqlProfile" not in result.extensions
@@ -1,13 +1,30 @@
 # mypy: disable-error-code="index"
 
 import pytest
-from sqlalchemy import select
+from sqlalchemy import create_engine, inspect, select, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
+from .. import compare
 from .. import models as m
 from .conftest import Login, Query
 
 
+def assert_packed(db: Session, response_id: int) -> None:
+    survey_id = db.get_one(m.Response, response_id).survey_id
+    questions = compare.in_packed_order(
+        db.scalars(select(m.Question).where(m.Question.survey_id == survey_id))
+    )
+    answers = {
+        a.question_id: a
+        for a in db.scalars(select(m.Answer).where(m.Answer.response_id == response_id))
+    }
+    bits = db.scalar(select(m.Response.answer_bits).where(m.Response.id == response_id))
+    assert compare.unpack(bits, len(questions)) == compare.encode(
+        [q.id for q in questions], answers
+    )
+
+
 @pytest.mark.asyncio
 async def test_createSurvey(db: Session, query: Query, login: Login, subtests):
     CREATE_SURVEY = """
@@ -76,13 +93,14 @@ async def test_addQuestion(db: Session, query: Query, login: Login, subtests):
 
         # add a question
         result = await query(
-            'mutation m { addQuestion(surveyId: 1, question: { text: "Test" }) { id } }'
+            'mutation m { addQuestion(surveyId: 1, question: { text: "Test", order: 2.5 }) { id } }'
         )
         assert result.data["addQuestion"]["id"] is not None
 
-        # check the question was created
+        # check the question was created, and is listed in order
         survey = await query("query q { survey(surveyId: 1) { questions { text } } }")
-        assert survey.data["survey"]["questions"][-1]["text"] == "Test"
+        texts = [q["text"] for q in survey.data["survey"]["questions"]]
+        assert texts[2:5] == ["Cats", "Test", "Dogs"]
 
 
 @pytest.mark.asyncio
@@ -277,6 +295,7 @@ async def test_saveAnswer_create(db: Session, query: Query, login: Login, subtes
     ).scalar_one()
     assert answer.value == m.WWW.WILL
     assert answer.flip == m.WWW.WONT
+    assert_packed(db, int(response_id))
 
 
 @pytest.mark.asyncio
@@ -303,3 +322,234 @@ async def test_saveAnswer_update(db: Session, query: Query, login: Login, subtes
         .where(m.Answer.question_id == 1)
     ).scalar_one()
     assert answer.value == m.WWW.WILL
+    assert_packed(db, response.id)
+
+
+SAVE_ANSWERS = """
+    mutation m($surveyId: Int!, $answers: [QuestionAnswerInput!]!) {
+        saveAnswers(surveyId: $surveyId, answers: $answers) { id value flip }
+    }
+"""
+
+
+@pytest.mark.asyncio
+async def test_saveAnswers_anon(query: Query):
+    await query(
+        SAVE_ANSWERS,
+        surveyId=1,
+        answers=[{"questionId": 1, "value": "WILL"}],
+        error="Anonymous users can't save answers",
+    )
+
+
+@pytest.mark.asyncio
+async def test_saveAnswers_bad_question(query: Query, login: Login):
+    await login("Alice")
+    await query(
+        SAVE_ANSWERS,
+        surveyId=1,
+        answers=[
+            {"questionId": 1, "value": "WILL"},
+            {"questionId": 999, "value": "WILL"},
+        ],
+        error="Question not found",
+    )
+    await query(
+        SAVE_ANSWERS,
+        surveyId=999,
+        answers=[{"questionId": 1, "value": "WILL"}],
+        error="Question not found",
+    )
+    result = await query(SAVE_ANSWERS, surveyId=1, answers=[])
+    assert result.data["saveAnswers"] == []
+
+
+@pytest.mark.asyncio
+async def test_saveAnswers_no_response(query: Query, login: Login):
+    await login("Frank")
+    await query(
+        SAVE_ANSWERS,
+        surveyId=1,
+        answers=[{"questionId": 1, "value": "WILL"}],
+        error="You haven't responded to this survey",
+    )
+
+
+@pytest.mark.asyncio
+async def test_saveAnswers(db: Session, query: Query, login: Login):
+    await login("Frank")
+    result = await query(
+        "mutation m { saveResponse(surveyId: 1, response: { privacy: PUBLIC }) { id } }"
+    )
+    response_id = int(result.data["saveResponse"]["id"])
+
+    # new answers
+    result = await query(
+        SAVE_ANSWERS,
+        surveyId=1,
+        answers=[
+            {"questionId": 2, "value": "WANT"},
+            {"questionId": 1, "value": "WILL", "flip": "WONT"},
+        ],
+    )
+    assert result.data["saveAnswers"] == [
+        {"id": 2, "value": "WANT", "flip": "NA"},
+        {"id": 1, "value": "WILL", "flip": "WONT"},
+    ]
+
+    # a mix of new and updated answers, in one statement, after one
+    # lookup each for the questions and the response - then invalidating
+    # comparisons, and re-packing the response's answers
+    alice = db.scalars(select(m.User).where(m.User.username == "Alice")).one()
+    mine = db.scalars(select(m.Response).where(m.Response.owner == alice)).one()
+    db.add(
+        m.CachedComparison(
+            my_response_id=mine.id,
+            their_response_id=response_id,
+            survey_id=1,
+            matches="[]",
+        )
+    )
+    db.flush()
+    result = await query(
+        SAVE_ANSWERS,
+        surveyId=1,
+        answers=[
+            {"questionId": 1, "value": "WANT"},
+            {"questionId": 3, "value": "WONT"},
+            {"questionId": 1, "value": "WONT"},
+        ],
+    )
+    assert result.data["saveAnswers"] == [
+        {"id": 1, "value": "WONT", "flip": "NA"},
+        {"id": 3, "value": "WONT", "flip": "NA"},
+    ]
+    assert result.extensions["queryCount"] == 6
+
+    response = db.get_one(m.Response, response_id)
+    assert {q: a.value for q, a in response.answers.items()} == {
+        1: m.WWW.WONT,
+        2: m.WWW.WANT,
+        3: m.WWW.WONT,
+    }
+    # the comparison with the old answers was thrown away
+    assert db.scalars(select(m.CachedComparison)).all() == []
+    assert_packed(db, response_id)
+
+
+@pytest.mark.asyncio
+async def test_saveAnswer_no_response(query: Query, login: Login):
+    await login("Frank")
+    await query(
+        "mutation m { saveAnswer(questionId: 1, answer: { value: WILL }) { id } }",
+        error="You haven't responded to this survey",
+    )
+
+
+@pytest.mark.asyncio
+async def test_save_is_one_write(db: Session, query: Query, login: Login):
+    await login("Frank")
+    await query("query q { user { username } }")  # warm the user cache
+
+    result = await query(
+        "mutation m { saveResponse(surveyId: 1, response: { privacy: PUBLIC }) { id } }"
+    )
+    assert result.extensions["queryCount"] == 1
+    result = await query(
+        "mutation m { saveResponse(surveyId: 1, response: { privacy: FRIENDS }) { id privacy } }"
+    )
+    assert result.extensions["queryCount"] == 1
+    assert result.data["saveResponse"]["privacy"] == "FRIENDS"
+
+    result = await query(
+        "mutation m { saveAnswer(questionId: 1, answer: { value: WILL }) { id } }"
+    )
+    # the upsert, throwing away cached comparisons, and re-packing answers
+    assert result.extensions["queryCount"] == 4
+    sql = [q["statement"] for q in result.extensions["sqlProfile"]["queries"]]
+    assert sql[0].startswith("INSERT INTO answer")
+
+    frank = db.scalars(select(m.User).where(m.User.username == "Frank")).one()
+    [response] = db.scalars(select(m.Response).where(m.Response.owner == frank))
+    assert response.privacy == m.Privacy.FRIENDS
+    assert response.answers[1].value == m.WWW.WILL
+
+
+def test_one_response_per_survey(db: Session):
+    alice = db.scalars(select(m.User).where(m.User.username == "Alice")).one()
+    db.add(m.Response(survey_id=1, user_id=alice.id))
+    with pytest.raises(IntegrityError):
+        db.flush()
+
+
+def test_upgrade_removes_duplicate_responses(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/test.sqlite")
+    m.Base.metadata.create_all(engine)
+    m.populate_example_data(Session(engine))
+    with engine.begin() as conn:
+        # an existing database from before the index was added
+        conn.execute(text("DROP INDEX ix_response_survey_user"))
+        conn.execute(
+            text(
+                "INSERT INTO response (id, user_id, survey_id, privacy) "
+                "SELECT 100, user_id, survey_id, privacy FROM response WHERE id = 1"
+            )
+        )
+        conn.execute(
+            text(
+                "INSERT INTO answer (response_id, question_id, value, flip) "
+                "VALUES (100, 1, 'WILL', 'NA')"
+            )
+        )
+
+    m.upgrade_schema(engine)
+    with Session(engine) as db:
+        assert db.get(m.Response, 100) is None
+        assert (
+            db.scalars(select(m.Answer).where(m.Answer.response_id == 100)).all() == []
+        )
+        assert db.get(m.Response, 1) is not None
+        db.add(m.Response(survey_id=1, user_id=db.get_one(m.Response, 1).user_id))
+        with pytest.raises(IntegrityError):
+            db.flush()
+
+
+def test_orm_changes_are_packed(db: Session):
+    for response_id in db.scalars(select(m.Response.id)):
+        assert_packed(db, response_id)
+
+    response = db.get_one(m.Response, 1)
+    response.answers[2].value = m.WWW.WANT
+    db.flush()
+    assert_packed(db, 1)
+    # orphans are deleted without ever being in db.deleted
+    del response.answers[3]
+    db.flush()
+    assert_packed(db, 1)
+
+    # later questions move down when one is removed
+    survey = db.get_one(m.Survey, 1)
+    db.execute(text("DELETE FROM answer WHERE question_id = 1"))
+    del survey.questions[1]
+    db.flush()
+    assert_packed(db, 1)
+
+
+def test_upgrade_packs_answers(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/test.sqlite")
+    m.Base.metadata.create_all(engine)
+    m.populate_example_data(Session(engine))
+    with engine.begin() as conn:
+        # an existing database from before answers were packed
+        conn.execute(text("ALTER TABLE response DROP COLUMN answer_bits"))
+        conn.execute(text("CREATE INDEX ix_question_survey_id ON question (survey_id)"))
+
+    m.upgrade_schema(engine)
+    indexes = {i["name"] for i in inspect(engine).get_indexes("question")}
+    assert indexes == {"ix_question_survey_order"}
+    assert compare.rebuild_answer_bits(engine, missing_only=True, batch_size=2) == 5
+    assert compare.rebuild_answer_bits(engine, missing_only=True) == 0
+    with Session(engine) as db:
+        for response_id in db.scalars(select(m.Response.id)):
+            assert_packed(db, response_id)
+    assert compare.rebuild_answer_bits(engine) == 5
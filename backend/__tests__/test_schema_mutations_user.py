@@ -5,6 +5,7 @@ from sqlalchemy import select
 from sqlalchemy.orm import Session
 
 from .. import models as m
+from .. import passwords
 from .conftest import Login, Logout, Query
 
 
@@ -124,6 +125,22 @@ async def test_login(query):
     assert result.data["login"] is None
 
 
+@pytest.mark.asyncio
+async def test_login_rehash(db: Session, login: Login, monkeypatch):
+    monkeypatch.setattr(m, "SECURE", True)
+    alice = db.scalars(select(m.User).where(m.User.username == "Alice")).one()
+    passwords.configure(rounds=5)
+    alice.password = passwords.hash_password("alicepass")
+    passwords.configure(rounds=4)
+    try:
+        await login("Alice")
+        assert alice.password.startswith("$2b$04$")
+        assert passwords.verify_password("alicepass", alice.password)
+        assert not alice.password_needs_rehash()
+    finally:
+        passwords.configure()
+
+
 @pytest.mark.asyncio
 async def test_login_logout(query: Query, login: Login, logout: Logout):
     # anonymous
@@ -3,9 +3,10 @@
 import itertools
 
 import pytest
-from sqlalchemy import select
+from sqlalchemy import create_engine, delete, select, text, update
 from sqlalchemy.orm import Session
 
+from .. import compare
 from .. import models as m
 from .. import schema as s
 from .conftest import Login, Logout, Query
@@ -18,6 +19,49 @@ async def test_surveys_paging(db: Session, query: Query, subtests):
         {"name": "Pets"},
     ]
 
+    for n in range(4):
+        db.add(
+            m.Survey(name=f"Survey {n}", description="", long_description="", user_id=1)
+        )
+    db.flush()
+    GET_PAGE = """
+        query q($first: Int!, $after: String) {
+            surveysConnection(first: $first, after: $after) {
+                edges { cursor node { name } }
+                pageInfo { hasNextPage endCursor }
+            }
+        }
+    """
+
+    with subtests.test("pages"):
+        names = []
+        after = None
+        while True:
+            result = await query(GET_PAGE, first=2, after=after)
+            page = result.data["surveysConnection"]
+            assert len(page["edges"]) <= 2
+            names.extend(edge["node"]["name"] for edge in page["edges"])
+            if not page["pageInfo"]["hasNextPage"]:
+                break
+            after = page["pageInfo"]["endCursor"]
+            assert after == page["edges"][-1]["cursor"]
+        assert names == ["Pets", "Survey 0", "Survey 1", "Survey 2", "Survey 3"]
+
+    with subtests.test("empty page"):
+        result = await query(GET_PAGE, first=5)
+        after = result.data["surveysConnection"]["pageInfo"]["endCursor"]
+        result = await query(GET_PAGE, first=5, after=after)
+        assert result.data["surveysConnection"] == {
+            "edges": [],
+            "pageInfo": {"hasNextPage": False, "endCursor": None},
+        }
+
+    with subtests.test("bad first"):
+        await query(GET_PAGE, first=0, error="first must be positive")
+
+    with subtests.test("bad cursor"):
+        await query(GET_PAGE, first=2, after="nonsense", error="Invalid cursor")
+
 
 @pytest.mark.asyncio
 async def test_survey_metadata(query: Query):
@@ -76,6 +120,57 @@ async def test_survey_stats(query: Query, subtests, login: Login):
         }
 
 
+@pytest.mark.asyncio
+async def test_survey_stats_unanswered(db: Session, query: Query, login: Login):
+    GET_STATS = "query q { survey(surveyId: 1) { stats { unansweredQuestions } } }"
+
+    # frank hasn't responded, so every question is unanswered
+    await login("Frank")
+    result = await query(GET_STATS)
+    assert result.data["survey"]["stats"] == {"unansweredQuestions": 9}
+
+    # alice has answered everything, apart from a new question
+    await login("Alice")
+    result = await query(
+        'mutation m { addQuestion(surveyId: 1, question: { text: "New" }) { id } }'
+    )
+    result = await query(GET_STATS)
+    assert result.data["survey"]["stats"] == {"unansweredQuestions": 1}
+
+
+@pytest.mark.asyncio
+async def test_surveys_stats_batched(db: Session, query: Query, login: Login):
+    GET_SURVEYS = """
+        query q {
+            surveys {
+                name
+                stats { friendResponses otherResponses unansweredQuestions }
+            }
+        }
+    """
+    await login("Alice")
+    before = await query(GET_SURVEYS)
+
+    alice = db.execute(select(m.User).where(m.User.username == "Alice")).scalar_one()
+    for n in range(10):
+        db.add(
+            m.Survey(
+                name=f"Survey {n}", description="", long_description="", owner=alice
+            )
+        )
+    db.flush()
+
+    after = await query(GET_SURVEYS)
+    assert len(after.data["surveys"]) == 11
+    assert after.data["surveys"][0] == before.data["surveys"][0]
+    assert after.data["surveys"][1]["stats"] == {
+        "friendResponses": 0,
+        "otherResponses": 0,
+        "unansweredQuestions": 0,
+    }
+    assert after.extensions["queryCount"] == before.extensions["queryCount"]
+
+
 @pytest.mark.asyncio
 async def test_survey_questions(query: Query):
     result = await query("""
@@ -102,6 +197,41 @@ async def test_survey_questions(query: Query):
     ]
 
 
+@pytest.mark.asyncio
+async def test_survey_questions_ordered(db: Session, query: Query):
+    db.get_one(m.Question, 9).order = -1.0
+    db.get_one(m.Question, 3).order = 4.0  # the same as rabbits
+    db.flush()
+    result = await query("""
+        query q {
+            survey(surveyId: 1) {
+                all: questions { id }
+                small: questions(section: "Small Animals") { id }
+                none: questions(section: "Nope") { id }
+            }
+        }
+    """)
+    ids = {k: [q["id"] for q in v] for k, v in result.data["survey"].items()}
+    assert ids == {
+        "all": [9, 1, 2, 4, 3, 5, 6, 7, 8],
+        "small": [4, 3, 5, 6, 7],
+        "none": [],
+    }
+
+
+def test_questions_index():
+    engine = create_engine("sqlite://")
+    m.Base.metadata.create_all(engine)
+    for section in [None, "Small Animals"]:
+        stmt = s.ordered_questions(1, section)
+        sql = str(stmt.compile(engine, compile_kwargs={"literal_binds": True}))
+        with engine.begin() as conn:
+            plan = str(conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all())
+        # the wording varies between SQLite versions (eg "COVERING INDEX")
+        assert "SEARCH" in plan and "ix_question_survey_order" in plan
+        assert "TEMP B-TREE" not in plan
+
+
 @pytest.mark.asyncio
 async def test_survey_myResponse(login: Login, query: Query, subtests):
     with subtests.test("anon"):
@@ -126,6 +256,38 @@ async def test_survey_myResponse(login: Login, query: Query, subtests):
         assert result.data["survey"]["myResponse"] is None
 
 
+@pytest.mark.asyncio
+async def test_surveys_myResponse_batched(db: Session, query: Query, login: Login):
+    GET_SURVEYS = """
+        query q {
+            surveys {
+                name
+                myResponse { id privacy }
+            }
+        }
+    """
+    await login("Alice")
+    before = await query(GET_SURVEYS)
+
+    alice = db.execute(select(m.User).where(m.User.username == "Alice")).scalar_one()
+    for n in range(10):
+        survey = m.Survey(
+            name=f"Survey {n}", description="", long_description="", owner=alice
+        )
+        db.add(survey)
+        if n % 2:
+            db.add(m.Response(survey=survey, owner=alice, privacy=m.Privacy.PUBLIC))
+    db.flush()
+
+    after = await query(GET_SURVEYS)
+    surveys = after.data["surveys"]
+    assert surveys[0] == before.data["surveys"][0]
+    assert [s["myResponse"] is not None for s in surveys[1:]] == [
+        bool(n % 2) for n in range(10)
+    ]
+    assert after.extensions["queryCount"] == before.extensions["queryCount"]
+
+
 @pytest.mark.asyncio
 async def test_survey_responses(
     db: Session, login: Login, logout: Logout, query: Query, subtests
@@ -188,6 +350,70 @@ async def test_survey_responses(
             assert (owner in response_owners) == expected
 
 
+@pytest.mark.asyncio
+async def test_survey_responses_many_friends(db: Session, login: Login, query: Query):
+    q = """
+        query q {
+            survey(surveyId: 1) {
+                responses {
+                    owner {
+                        username
+                        isFriend
+                    }
+                }
+            }
+        }
+    """
+    await login("Alice")
+    before = await query(q)
+
+    # friendship checks are a set lookup, so more friends means no more queries
+    alice = db.execute(select(m.User).where(m.User.username == "Alice")).scalar_one()
+    for n in range(30):
+        friend = m.User(f"friend{n}", "pass")
+        db.add(m.Friendship(friend_a=alice, friend_b=friend, confirmed=True))
+        db.add(m.Response(survey_id=1, owner=friend, privacy=m.Privacy.FRIENDS))
+    db.flush()
+
+    after = await query(q)
+    owners = [r["owner"] for r in after.data["survey"]["responses"]]
+    assert len(owners) == len(before.data["survey"]["responses"]) + 30
+    assert {"username": "friend29", "isFriend": True} in owners
+    assert after.extensions["queryCount"] == before.extensions["queryCount"]
+
+
+@pytest.mark.asyncio
+async def test_survey_responses_paging(db: Session, login: Login, query: Query):
+    GET_PAGE = """
+        query q($after: String) {
+            survey(surveyId: 1) {
+                responsesConnection(first: 2, after: $after) {
+                    edges { node { owner { username } } }
+                    pageInfo { hasNextPage endCursor }
+                }
+            }
+        }
+    """
+    db.execute(
+        select(m.Response).where(m.Response.user_id == 4)
+    ).scalar_one().privacy = m.Privacy.PUBLIC
+
+    # alice can see her own response, bob (friend), and dave (public)
+    await login("Alice")
+    page1 = (await query(GET_PAGE)).data["survey"]["responsesConnection"]
+    assert page1["pageInfo"]["hasNextPage"] is True
+    after = page1["pageInfo"]["endCursor"]
+    page2 = (await query(GET_PAGE, after=after)).data["survey"]["responsesConnection"]
+    assert page2["pageInfo"]["hasNextPage"] is False
+    assert [
+        e["node"]["owner"]["username"] for e in page1["edges"] + page2["edges"]
+    ] == [
+        "Alice",
+        "Bob",
+        "Dave",
+    ]
+
+
 @pytest.mark.asyncio
 async def test_response(db: Session, query: Query, login: Login, subtests):
     q = """
@@ -320,6 +546,12 @@ async def test_response_answers(db: Session, query: Query, login: Login, subtest
         assert result.data is None
 
 
+@pytest.fixture(params=[True, False], ids=["sql", "memory"])
+def sql_comparison(request, monkeypatch) -> bool:
+    monkeypatch.setattr(s, "SQL_COMPARISON", request.param)
+    return request.param
+
+
 COMPARE_RESPONSE = """
     query q($responseId: Int!) {
         response(responseId: $responseId) {
@@ -355,7 +587,9 @@ async def test_response_comparison_anon(db: Session, query: Query):
 
 
 @pytest.mark.asyncio
-async def test_response_comparison_self(db: Session, query: Query, login: Login):
+async def test_response_comparison_self(
+    db: Session, query: Query, login: Login, sql_comparison: bool
+):
     # user can't compare themselves
     await login("Alice")
     assert (
@@ -440,7 +674,9 @@ async def test_response_comparison_anonymous(db: Session, query: Query, login: L
 
 
 @pytest.mark.asyncio
-async def test_response_comparison_noresponse(db: Session, query: Query, login: Login):
+async def test_response_comparison_noresponse(
+    db: Session, query: Query, login: Login, sql_comparison: bool
+):
     # frank hasn't responded to the survey, he shouldn't be able to compare
     # his response to anyone else's, even public ones
     frank = db.execute(select(m.User).where(m.User.username == "Frank")).scalar_one()
@@ -465,7 +701,7 @@ async def test_response_comparison_noresponse(db: Session, query: Query, login:
 
 @pytest.mark.asyncio
 async def test_response_comparison_nonflip(
-    db: Session, query: Query, login: Login, subtests
+    db: Session, query: Query, login: Login, subtests, sql_comparison: bool
 ):
     # we can see bob's response, and should be able to see or
     # not-see specific answers based on their value
@@ -523,7 +759,7 @@ async def test_response_comparison_nonflip(
 
 @pytest.mark.asyncio
 async def test_response_comparison_flip(
-    db: Session, query: Query, login: Login, subtests
+    db: Session, query: Query, login: Login, subtests, sql_comparison: bool
 ):
     # we can see bob's response, and should be able to see or
     # not-see specific answers based on their value
@@ -618,3 +854,128 @@ async def test_response_comparison_flip(
                 assert cs[0]["theirs"] == bob_value.name
             else:
                 assert len(cs) == 0
+
+
+@pytest.mark.asyncio
+async def test_response_comparison_query_count(db: Session, query: Query, login: Login):
+    # comparing is a single query, no matter how many questions there are
+    bob = db.execute(select(m.User).where(m.User.username == "Bob")).scalar_one()
+    response = db.execute(
+        select(m.Response).where(m.Response.owner == bob)
+    ).scalar_one()
+    await login("Alice")
+    await query(COMPARE_RESPONSE, responseId=response.id)  # warm up lazy-loads
+    db.execute(delete(m.CachedComparison))
+    before = await query(COMPARE_RESPONSE, responseId=response.id)
+
+    survey = db.execute(select(m.Survey).where(m.Survey.name == "Pets")).scalar_one()
+    for n in range(50):
+        q = m.Question(text=f"q{n}", flip=f"f{n}" if n % 2 else None)
+        survey.questions[1000 + n] = q
+        db.flush()
+        for r in survey.responses:
+            r.answers[q.id] = m.Answer(
+                question_id=q.id, response_id=r.id, value=m.WWW.WANT, flip=m.WWW.WILL
+            )
+    db.flush()
+
+    db.execute(delete(m.CachedComparison))
+    after = await query(COMPARE_RESPONSE, responseId=response.id)
+    assert len(after.data["response"]["comparison"]) == (
+        len(before.data["response"]["comparison"]) + 75
+    )
+    assert after.extensions["queryCount"] == before.extensions["queryCount"]
+
+
+@pytest.mark.asyncio
+async def test_response_comparison_cache(db: Session, query: Query, login: Login):
+    bob = db.execute(select(m.User).where(m.User.username == "Bob")).scalar_one()
+    response = db.execute(
+        select(m.Response).where(m.Response.owner == bob)
+    ).scalar_one()
+    await login("Alice")
+    stats = compare.cache_stats
+    hits, misses = stats.hits, stats.misses
+
+    # first comparison is computed and saved
+    miss = await query(COMPARE_RESPONSE, responseId=response.id)
+    assert (stats.hits, stats.misses) == (hits, misses + 1)
+
+    # second comparison comes straight from the cache
+    hit = await query(COMPARE_RESPONSE, responseId=response.id)
+    assert (stats.hits, stats.misses) == (hits + 1, misses + 1)
+    assert hit.data == miss.data
+    assert hit.extensions["queryCount"] < miss.extensions["queryCount"]
+
+    # bob changing an answer invalidates the cache
+    await login("Bob")
+    await query("""
+        mutation m {
+            saveAnswer(questionId: 3, answer: { value: WONT }) { value }
+        }
+    """)
+    await login("Alice")
+    changed = await query(COMPARE_RESPONSE, responseId=response.id)
+    assert (stats.hits, stats.misses) == (hits + 1, misses + 2)
+    assert changed.data != miss.data
+
+    # a comparison saved from answers that have changed since (eg by a save
+    # that committed while it was being made) is never served
+    db.execute(
+        update(m.Answer)
+        .where(m.Answer.response_id == response.id, m.Answer.question_id == 3)
+        .values(value=m.WWW.WILL)
+    )
+    compare.pack_answers(db, [response.id])
+    await query(COMPARE_RESPONSE, responseId=response.id)
+    assert (stats.hits, stats.misses) == (hits + 1, misses + 3)
+    await query(COMPARE_RESPONSE, responseId=response.id)
+    assert (stats.hits, stats.misses) == (hits + 2, misses + 3)
+
+
+BEST_MATCHES = """
+    query q($limit: Int!) {
+        survey(surveyId: 1) {
+            bestMatches(limit: $limit) {
+                matches
+                response { id owner { username } comparison { text } }
+            }
+        }
+    }
+"""
+
+
+@pytest.mark.asyncio
+async def test_best_matches(db: Session, query: Query, login: Login):
+    privacy = {
+        "Bob": m.Privacy.FRIENDS,  # a friend
+        "Charlie": m.Privacy.FRIENDS,  # not a friend
+        "Dave": m.Privacy.PUBLIC,
+        "Evette": m.Privacy.ANONYMOUS,
+    }
+    for response in db.scalars(select(m.Response)):
+        response.privacy = privacy.get(response.owner.username, response.privacy)
+    db.flush()
+
+    await login("Alice")
+    result = await query(BEST_MATCHES, limit=10)
+    best = result.data["survey"]["bestMatches"]
+    # only the responses in Survey.responses, and not my own
+    assert sorted(b["response"]["owner"]["username"] for b in best) == ["Bob", "Dave"]
+    for b in best:
+        assert b["matches"] == len(b["response"]["comparison"])
+    assert [b["matches"] for b in best] == sorted(
+        (b["matches"] for b in best), reverse=True
+    )
+
+    result = await query(BEST_MATCHES, limit=1)
+    assert result.data["survey"]["bestMatches"] == best[:1]
+
+
+@pytest.mark.asyncio
+async def test_best_matches_errors(query: Query, login: Login):
+    await query(BEST_MATCHES, limit=10, error="Anonymous users can't view responses")
+    await login("Frank")
+    await query(BEST_MATCHES, limit=10, error="You haven't responded to this survey")
+    await login("Alice")
+    await query(BEST_MATCHES, limit=0, error="limit must be positive")
@@ -62,3 +62,22 @@ async def test_user_others(query: Query, login: Login, subtests):
             error="You can only view your own data.",
         )
         assert result.data["user"] is None
+
+
+@pytest.mark.asyncio
+async def test_user_friends_paging(query: Query, login: Login):
+    await login("Alice")
+    result = await query("""
+        query q {
+            user {
+                friendsConnection(first: 1) {
+                    edges { node { username } }
+                    pageInfo { hasNextPage }
+                }
+            }
+        }
+    """)
+    assert result.data["user"]["friendsConnection"] == {
+        "edges": [{"node": {"username": "Bob"}}],
+        "pageInfo": {"hasNextPage": False},
+    }
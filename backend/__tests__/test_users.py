@@ -0,0 +1,108 @@
+# mypy: disable-error-code="index"
+
+import pytest
+from sqlalchemy import create_engine, event, func, select, text
+from sqlalchemy.orm import Session
+
+from .. import models as m
+from .. import users
+from .conftest import Login, Query
+
+
+def test_by_username_cached(db: Session):
+    alice = users.by_username(db, "alice")
+    assert alice and alice.username == "Alice"
+    db.commit()
+
+    # a new session gets an attached copy without a query
+    statements = []
+
+    def on_execute(conn, cursor, statement, *args):  # pragma: no cover
+        statements.append(statement)
+
+    with Session(db.get_bind()) as db2:
+        event.listen(db2.get_bind(), "before_cursor_execute", on_execute)
+        try:
+            copy = users.by_username(db2, "ALICE")
+        finally:
+            event.remove(db2.get_bind(), "before_cursor_execute", on_execute)
+        assert statements == []
+        assert copy is not None and copy is not alice
+        assert copy in db2
+        assert (copy.id, copy.username, copy.email) == (
+            alice.id,
+            alice.username,
+            alice.email,
+        )
+        assert not db2.is_modified(copy)
+
+    assert users.by_username(db, "nobody") is None
+    assert "nobody" not in users.cache
+
+
+@pytest.mark.asyncio
+async def test_get_me_cached(query: Query, login: Login):
+    await login("Alice")
+    result = await query("query q { user { username } }")
+    assert result.data["user"]["username"] == "Alice"
+    assert result.extensions["queryCount"] == 0
+
+
+@pytest.mark.asyncio
+async def test_rename_forgets(db: Session, query: Query, login: Login):
+    await login("Alice")
+    assert "alice" in users.cache
+    await query(
+        """
+        mutation m {
+            updateUser(username: "Alicia", password: "alicepass", password1: "", password2: "", email: "") {
+                username
+            }
+        }
+        """
+    )
+    assert "alice" not in users.cache
+    assert users.by_username(db, "alice") is None
+    renamed = users.by_username(db, "alicia")
+    assert renamed and renamed.username == "Alicia"
+
+
+@pytest.mark.asyncio
+async def test_password_not_cached(db: Session, query: Query, login: Login):
+    await login("Alice")
+    snapshot = users.cache.get("alice")
+    assert snapshot is not None and "password" not in snapshot
+    # another worker changes the password, and this one's next request
+    # (with a new session) still has Alice cached
+    db.execute(text("UPDATE user SET password = 'newpass' WHERE username = 'Alice'"))
+    db.expunge_all()
+    assert "alice" in users.cache
+
+    await query(
+        """
+        mutation m {
+            login(username: "Alice", password: "alicepass") { username }
+        }
+        """,
+        error="User not found",
+    )
+    await login("Alice", "newpass")
+
+
+def test_username_index():
+    engine = create_engine("sqlite://")
+    m.Base.metadata.create_all(engine)
+    stmt = select(m.User.id).where(func.lower(m.User.username) == "alice")
+    sql = str(stmt.compile(engine, compile_kwargs={"literal_binds": True}))
+    with engine.begin() as conn:
+        # an existing database from before the index was added
+        conn.execute(text("DROP INDEX ix_user_username_lower"))
+        plan = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+        assert "ix_user_username_lower" not in str(plan)
+
+    m.upgrade_schema(engine)
+    m.upgrade_schema(engine)  # and again, with nothing to do
+    with engine.begin() as conn:
+        plan = str(conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all())
+        # the wording varies between SQLite versions (eg "COVERING INDEX")
+        assert "SEARCH" in plan and "ix_user_username_lower" in plan
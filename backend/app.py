@@ -1,28 +1,118 @@
 import datetime
+import functools
 import os
+import typing as t
 
 import click
 from flask import Flask, Request, Response, g, jsonify, session
-from sqlalchemy import create_engine
+from sqlalchemy import URL, Engine, create_engine, event, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.orm import Session
 from strawberry.flask.views import AsyncGraphQLView
 from strawberry_sqlalchemy_mapper import StrawberrySQLAlchemyLoader
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from . import (
+    compare,
+    documents,
+    health,
+    metrics,
+    passwords,
+    query_cost,
+    query_counter,
+    users,
+)
 from . import models as m
 from . import schema as s
+from .loaders import Loaders
 
 
-class MyGraphQLView(AsyncGraphQLView):
+class RequestSession(Session):
+    """
+    A Session which remembers whether it has written anything, so that
+    read-only requests can skip the commit
+    """
+
+    @property
+    def has_writes(self) -> bool:
+        return self.info.get("writes", False)
+
+
+@event.listens_for(RequestSession, "after_flush")
+def _flush_wrote(db: Session, flush_context) -> None:
+    db.info["writes"] = True
+
+
+@event.listens_for(RequestSession, "do_orm_execute")
+def _statement_wrote(state) -> None:
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info["writes"] = True
+
+
+class MyGraphQLView(documents.PersistedQueries, AsyncGraphQLView):
     async def get_context(self, request: Request, response: Response):
         return {
             "db": g.db,
             "cookie": session,
             "cache": {},
             "sqlalchemy_loader": StrawberrySQLAlchemyLoader(bind=g.db),
+            "loaders": Loaders(g.db),
         }
 
 
+# drivers for create_async_db_engine, by backend - only sqlite, because
+# that's the only driver we depend on, and the upserts are sqlite's
+ASYNC_DRIVERS = {"sqlite": "aiosqlite"}
+
+
+def _engine_args(config: dict[str, t.Any]) -> tuple[URL, dict[str, t.Any]]:
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    options: dict[str, t.Any] = {
+        "echo": config.get("SQLALCHEMY_DATABASE_ECHO"),
+        "pool_pre_ping": config.get("SQLALCHEMY_POOL_PRE_PING"),
+    }
+    # in-memory sqlite databases use a connection-per-thread pool
+    if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+        options["pool_size"] = config.get("SQLALCHEMY_POOL_SIZE")
+        options["max_overflow"] = config.get("SQLALCHEMY_MAX_OVERFLOW")
+    return url, options
+
+
+def _set_sqlite_pragmas(engine: Engine, config: dict[str, t.Any]) -> None:
+    pragmas = config.get("SQLITE_PRAGMAS")
+    if engine.url.get_backend_name() != "sqlite" or not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
+def create_db_engine(config: dict[str, t.Any]) -> Engine:
+    url, options = _engine_args(config)
+    engine = create_engine(url, **options)
+    _set_sqlite_pragmas(engine, config)
+    return engine
+
+
+def create_async_db_engine(config: dict[str, t.Any]) -> AsyncEngine:
+    """
+    The same database and settings as create_db_engine, through the
+    backend's asyncio driver
+    """
+    url, options = _engine_args(config)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend} databases")
+    url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    engine = create_async_engine(url, **options)
+    _set_sqlite_pragmas(engine.sync_engine, config)
+    return engine
+
+
 def create_app(test_config=None):
     ###################################################################
     # Load config
@@ -36,6 +126,40 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SQLALCHEMY_DATABASE_URI="sqlite:///data/link2.sqlite",
         SQLALCHEMY_DATABASE_ECHO=False,
+        SQLALCHEMY_POOL_SIZE=5,
+        SQLALCHEMY_MAX_OVERFLOW=10,
+        SQLALCHEMY_POOL_PRE_PING=True,
+        SQLITE_PRAGMAS={
+            # let readers carry on while somebody else is writing
+            "journal_mode": "WAL",
+            # WAL is still crash-safe without syncing every commit
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            # wait for locks rather than failing with "database is locked"
+            "busy_timeout": 5000,
+            # negative = KiB
+            "cache_size": -32 * 1024,
+        },
+        PASSWORD_HASH_WORKERS=passwords.DEFAULT_WORKERS,
+        PASSWORD_HASH_ROUNDS=passwords.DEFAULT_ROUNDS,
+        PASSWORD_CACHE_SIZE=passwords.DEFAULT_CACHE_SIZE,
+        PASSWORD_CACHE_TTL=passwords.DEFAULT_CACHE_TTL,
+        USER_CACHE_SIZE=users.DEFAULT_CACHE_SIZE,
+        USER_CACHE_TTL=users.DEFAULT_CACHE_TTL,
+        GRAPHQL_DOCUMENT_CACHE_SIZE=documents.DEFAULT_DOCUMENT_CACHE_SIZE,
+        GRAPHQL_PERSISTED_QUERIES_SIZE=documents.DEFAULT_PERSISTED_QUERIES_SIZE,
+        # see query_cost.Limits for the defaults
+        GRAPHQL_MAX_COST=query_cost.Limits.max_cost,
+        GRAPHQL_MAX_DEPTH=query_cost.Limits.max_depth,
+        GRAPHQL_FIELD_COSTS={},
+        GRAPHQL_LIST_SIZES={},
+        # "extensions" or "log" - defaults to extensions when debugging
+        GRAPHQL_PROFILE=None,
+        GRAPHQL_PROFILE_SLOW_MS=query_counter.SLOW_MS,
+        # where each worker writes its metrics for /metrics to merge
+        METRICS_DIR=None,
+        # see health.Thresholds for the defaults
+        HEALTH_CHECK={},
         SESSION_COOKIE_SECURE=True,
         SESSION_COOKIE_SAMESITE="None",
         PERMANENT_SESSION_LIFETIME=datetime.timedelta(days=365),
@@ -52,16 +176,46 @@ def create_app(test_config=None):
         app.config.from_mapping(
             SECRET_KEY=secret_key,
         )
+        if app.config["METRICS_DIR"] is None:
+            app.config["METRICS_DIR"] = "./data/metrics"
     else:
         # load the test config if passed in
         app.config.from_mapping(test_config)
 
+    passwords.configure(
+        workers=app.config["PASSWORD_HASH_WORKERS"],
+        rounds=app.config["PASSWORD_HASH_ROUNDS"],
+        cache_size=app.config["PASSWORD_CACHE_SIZE"],
+        cache_ttl=app.config["PASSWORD_CACHE_TTL"],
+    )
+    users.configure(
+        size=app.config["USER_CACHE_SIZE"], ttl=app.config["USER_CACHE_TTL"]
+    )
+    documents.configure(
+        document_cache_size=app.config["GRAPHQL_DOCUMENT_CACHE_SIZE"],
+        persisted_queries_size=app.config["GRAPHQL_PERSISTED_QUERIES_SIZE"],
+    )
+    query_cost.configure(
+        max_cost=app.config["GRAPHQL_MAX_COST"],
+        max_depth=app.config["GRAPHQL_MAX_DEPTH"],
+        field_costs=app.config["GRAPHQL_FIELD_COSTS"],
+        list_sizes=app.config["GRAPHQL_LIST_SIZES"],
+    )
+    metrics.configure(app.config["METRICS_DIR"])
+    query_counter.configure(
+        mode=app.config["GRAPHQL_PROFILE"] or ("extensions" if app.debug else "log"),
+        slow_ms=app.config["GRAPHQL_PROFILE_SLOW_MS"],
+    )
+
     ###################################################################
     # Load database
 
-    engine = create_engine(
-        app.config.get("SQLALCHEMY_DATABASE_URI"),  # type: ignore
-        echo=app.config.get("DATABASE_ECHO"),
+    engine = create_db_engine(app.config)
+    metrics.track_pool(engine)
+    health_check = health.HealthCheck(
+        engine,
+        max_overflow=app.config["SQLALCHEMY_MAX_OVERFLOW"],
+        thresholds=health.Thresholds(**app.config["HEALTH_CHECK"]),
     )
 
     @click.command("init-db")
@@ -73,28 +227,57 @@ def create_app(test_config=None):
             m.populate_example_data(Session(engine))
         click.echo("Initialized the database.")
 
-    @app.before_request
-    def connect_db() -> None:
-        g.db = Session(engine)
-        # ensure that there is an open connection from the start of the request,
-        # to avoid connections being opened on-demand in other threads
-        g.db.connection()
+    @click.command("upgrade-db")
+    def upgrade_db_command():  # pragma: no cover
+        """Create any tables and indexes that are missing from an existing database."""
+        m.upgrade_schema(engine)
+        packed = compare.rebuild_answer_bits(engine, missing_only=True)
+        click.echo(f"Upgraded the database, and packed {packed} responses' answers.")
+
+    @click.command("pack-answers")
+    def pack_answers_command():  # pragma: no cover
+        """Rebuild every response's packed answers from the answer table."""
+        packed = compare.rebuild_answer_bits(engine)
+        click.echo(f"Packed {packed} responses' answers.")
+
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(pack_answers_command)
+
+    def needs_db(view):
+        """
+        Open a session for routes that use the database - everything else
+        (static files, health checks) never touches the connection pool
+        """
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.db = RequestSession(engine)
+            # ensure that there is an open connection from the start of the request,
+            # to avoid connections being opened on-demand in other threads
+            g.db.connection()
+            return view(*args, **kwargs)
+
+        return wrapper
 
     @app.teardown_request
     def teardown_db(exception=None) -> None:
+        db: RequestSession | None = g.pop("db", None)
+        if db is None:
+            return
         if exception:
-            g.db.rollback()
-        else:
-            g.db.commit()
-        g.db.close()
+            db.rollback()
+        elif db.has_writes:
+            db.commit()
+        db.close()
 
     ###################################################################
     # Public routes
 
     app.add_url_rule(
         "/graphql",
-        view_func=MyGraphQLView.as_view(
-            "graphql_view", schema=s.schema, graphql_ide=True
+        view_func=needs_db(
+            MyGraphQLView.as_view("graphql_view", schema=s.schema, graphql_ide=True)
         ),
     )
 
@@ -104,7 +287,27 @@ def create_app(test_config=None):
 
     @app.route("/heartbeat")
     def heartbeat():
-        return jsonify({"status": "healthy"})
+        return jsonify(
+            {
+                "status": "healthy",
+                "comparison_cache": {
+                    "hits": compare.cache_stats.hits,
+                    "misses": compare.cache_stats.misses,
+                },
+            }
+        )
+
+    @app.route("/ready")
+    def ready():
+        # unlike /heartbeat, this checks that we can actually serve requests
+        result = health_check.check()
+        return jsonify(result), 503 if result["status"] == "unhealthy" else 200
+
+    @app.route("/metrics")
+    def metrics_endpoint() -> Response:
+        return Response(
+            metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
 
     @app.route("/assets/<path:x>")
     def assets(x) -> Response:
@@ -0,0 +1,142 @@
+"""
+An ASGI entry point, for running under uvicorn:
+
+    uv run uvicorn --factory backend.asgi:create_asgi_app
+
+/graphql runs on the event loop with an async database session, so one
+worker can serve many requests while they wait for the database.
+Everything else (static files, health checks, metrics) is the Flask app
+from create_app, run in a thread pool.
+"""
+
+import contextlib
+import typing as t
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import Flask
+from flask.sessions import SessionMixin
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_session
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from starlette.websockets import WebSocket
+from strawberry.asgi import GraphQL
+from strawberry.http import GraphQLRequestData
+from strawberry.http.async_base_view import AsyncHTTPRequestAdapter
+from strawberry.types import ExecutionResult, SubscriptionExecutionResult
+from strawberry_sqlalchemy_mapper import StrawberrySQLAlchemyLoader
+
+from . import documents, metrics
+from . import schema as s
+from .app import RequestSession, create_app, create_async_db_engine
+from .loaders import Loaders
+
+
+class _CookieResponse:
+    """
+    Just enough of a werkzeug Response for Flask's session interface to
+    save the cookie session onto a starlette Response
+    """
+
+    def __init__(self, response: Response):
+        self.response = response
+        self.vary: set[str] = set()
+
+    def set_cookie(self, key: str, value: str = "", *, samesite=None, **kwargs):
+        samesite = samesite.lower() if samesite else None
+        self.response.set_cookie(key, value, samesite=samesite, **kwargs)
+
+    def delete_cookie(self, key: str, *, samesite=None, **kwargs):
+        samesite = samesite.lower() if samesite else None
+        self.response.delete_cookie(key, samesite=samesite, **kwargs)
+
+
+class MyGraphQLApp(documents.PersistedQueries, GraphQL[s.Context, None]):
+    def __init__(self, flask_app: Flask, engine: AsyncEngine, **kwargs):
+        super().__init__(**kwargs)
+        self.flask_app = flask_app
+        self.engine = engine
+
+    async def get_context(
+        self, request: Request | WebSocket, response: Response | WebSocket
+    ) -> s.Context:
+        db = AsyncSession(self.engine, sync_session_class=RequestSession)
+        # the same signed cookie as the Flask app uses
+        interface = self.flask_app.session_interface
+        cookie = interface.open_session(self.flask_app, request)  # type: ignore
+        if cookie is None:
+            cookie = interface.make_null_session(self.flask_app)
+        return {
+            "db": db.sync_session,
+            "cookie": cookie,
+            "cache": {},
+            # relationship batches run in their own task, outside of any
+            # resolver, so they use the async API
+            "sqlalchemy_loader": StrawberrySQLAlchemyLoader(
+                async_bind_factory=lambda: contextlib.nullcontext(db)
+            ),
+            "loaders": Loaders(db.sync_session),
+        }
+
+    async def execute_operation(
+        self,
+        request: Request,
+        request_adapter: AsyncHTTPRequestAdapter,
+        request_data: GraphQLRequestData | list[GraphQLRequestData],
+        context: s.Context,
+        root_value: None,
+        sub_response: Response,
+    ) -> ExecutionResult | list[ExecutionResult] | SubscriptionExecutionResult:
+        db = async_session(context["db"])
+        assert db is not None
+        try:
+            # connect up-front, so that extensions can use the connection
+            # without doing any IO
+            await db.connection()
+            result = await super().execute_operation(
+                request=request,
+                request_adapter=request_adapter,
+                request_data=request_data,
+                context=context,
+                root_value=root_value,
+                sub_response=sub_response,
+            )
+            if t.cast(RequestSession, context["db"]).has_writes:
+                await db.commit()
+        finally:
+            await db.close()
+        self.save_cookie(context["cookie"], sub_response)
+        return result
+
+    def save_cookie(self, cookie: SessionMixin, response: Response) -> None:
+        interface = self.flask_app.session_interface
+        if interface.is_null_session(cookie):
+            return
+        adapter = _CookieResponse(response)
+        interface.save_session(self.flask_app, cookie, adapter)  # type: ignore
+        if adapter.vary:
+            response.headers.append("Vary", ", ".join(sorted(adapter.vary)))
+
+
+def create_asgi_app(test_config=None) -> Starlette:
+    flask_app = create_app(test_config)
+    engine = create_async_db_engine(flask_app.config)
+    # /graphql's connections come from this pool, not the Flask app's
+    metrics.track_pool(engine.sync_engine)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: Starlette) -> t.AsyncIterator[None]:
+        yield
+        await engine.dispose()
+
+    return Starlette(
+        routes=[
+            Route(
+                "/graphql",
+                MyGraphQLApp(flask_app, engine, schema=s.schema, graphql_ide=True),
+            ),
+            Mount("/", app=WsgiToAsgi(flask_app)),
+        ],
+        lifespan=lifespan,
+    )
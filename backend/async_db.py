@@ -0,0 +1,49 @@
+"""
+Running the (synchronous) ORM code in resolvers on top of an async engine.
+
+Under ASGI, the request's session is an AsyncSession, and resolvers get
+its `.sync_session` - the same Session API that they get under Flask.
+SQLAlchemy can only do IO through that from inside a greenlet, the way
+AsyncSession's own methods do it, so resolvers which use the database
+wrap that code in `run` (or the whole resolver in `uses_db`). With a
+plain synchronous session, both just call the code.
+"""
+
+import functools
+import typing as t
+from collections import abc
+
+from sqlalchemy.ext.asyncio import async_session
+from sqlalchemy.orm import Session
+from sqlalchemy.util import greenlet_spawn
+
+
+def is_async(db: Session) -> bool:
+    return async_session(db) is not None
+
+
+async def run[**P, R](
+    db: Session, fn: abc.Callable[P, R], *args: P.args, **kwargs: P.kwargs
+) -> R:
+    """
+    Call fn, which uses db, somewhere that db can do IO
+    """
+    if is_async(db):
+        return await greenlet_spawn(functools.partial(fn, *args, **kwargs))
+    return fn(*args, **kwargs)
+
+
+def uses_db[**P, R](
+    resolver: abc.Callable[P, R],
+) -> abc.Callable[P, abc.Coroutine[t.Any, t.Any, R]]:
+    """
+    Make a sync resolver (with an `info` argument) async, running it with
+    `run` - for resolvers which query, flush, or lazy-load anything
+    """
+
+    @functools.wraps(resolver)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        info = t.cast(t.Any, kwargs["info"])
+        return await run(info.context["db"], resolver, *args, **kwargs)
+
+    return wrapper
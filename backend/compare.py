@@ -0,0 +1,538 @@
+import dataclasses
+import heapq
+import itertools
+import json
+import operator
+import typing as t
+from collections import abc
+
+from sqlalchemy import (
+    ColumnElement,
+    Engine,
+    Select,
+    SQLColumnExpression,
+    String,
+    and_,
+    bindparam,
+    delete,
+    event,
+    or_,
+    select,
+    type_coerce,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session, aliased, object_session
+
+from . import models as m
+
+visible_combos = [
+    (m.WWW.WILL, m.WWW.WANT),
+    (m.WWW.WANT, m.WWW.WILL),
+    (m.WWW.WANT, m.WWW.WANT),
+]
+
+# One byte per question, in question order. Unanswered questions are
+# encoded the same as NA, which never takes part in a match.
+CODES: dict[m.WWW, int] = {m.WWW.NA: 0, m.WWW.WANT: 1, m.WWW.WILL: 2, m.WWW.WONT: 3}
+_DECODE: dict[int, m.WWW] = {code: www for www, code in CODES.items()}
+_PLANES: dict[m.WWW, bytes] = {
+    www: bytes(1 if n == code else 0 for n in range(256)) for www, code in CODES.items()
+}
+
+
+class Vector(t.NamedTuple):
+    value: bytes
+    flip: bytes
+
+
+class Match(t.NamedTuple):
+    section: str
+    order: float
+    text: str
+    flip: str | None
+    mine: m.WWW
+    theirs: m.WWW
+
+
+def _match(q: m.Question, mine: m.WWW, theirs: m.WWW, flipped: bool = False) -> Match:
+    # a match on the flip side of a question is shown as the flipped text
+    # (only questions with a flip have one, but text is never null)
+    if flipped:
+        return Match(q.section, q.order, q.flip or q.text, q.text, mine, theirs)
+    return Match(q.section, q.order, q.text, q.flip or None, mine, theirs)
+
+
+def encode(
+    question_ids: abc.Sequence[int], answers: abc.Mapping[int, m.Answer]
+) -> Vector:
+    value = bytearray(len(question_ids))
+    flip = bytearray(len(question_ids))
+    for n, qid in enumerate(question_ids):
+        if a := answers.get(qid):
+            value[n] = CODES[a.value]
+            # flip isn't set on new answers until they've been flushed
+            flip[n] = CODES[a.flip or m.WWW.NA]
+    return Vector(bytes(value), bytes(flip))
+
+
+def _plane(codes: bytes, www: m.WWW) -> int:
+    # each question gets its own byte-wide lane in a big int, so that
+    # bitwise operations compare every question at once
+    return int.from_bytes(codes.translate(_PLANES[www]), "little")
+
+
+def _lanes(mask: int, length: int) -> bytes:
+    return mask.to_bytes(length, "little")
+
+
+def compare(
+    questions: abc.Sequence[m.Question], mine: Vector, theirs: Vector
+) -> list[Match]:
+    """
+    Find the answers that we have in common - for flipped questions, my
+    answer to one side is compared to their answer to the other side
+    """
+    n = len(questions)
+    flips = int.from_bytes(bytes(1 if q.flip else 0 for q in questions), "little")
+
+    forward = 0
+    backward = 0
+    for a, b in visible_combos:
+        their_side = (_plane(theirs.value, b) & ~flips) | (
+            _plane(theirs.flip, b) & flips
+        )
+        forward |= _plane(mine.value, a) & their_side
+        backward |= _plane(mine.flip, a) & _plane(theirs.value, b) & flips
+
+    fwd = _lanes(forward, n)
+    bwd = _lanes(backward, n)
+    hits = _lanes(forward | backward, n)
+
+    matches: list[Match] = []
+    i = hits.find(1)
+    while i != -1:
+        q = questions[i]
+        if fwd[i]:
+            their_code = theirs.flip[i] if q.flip else theirs.value[i]
+            matches.append(_match(q, _DECODE[mine.value[i]], _DECODE[their_code]))
+        if bwd[i]:
+            matches.append(
+                _match(q, _DECODE[mine.flip[i]], _DECODE[theirs.value[i]], True)
+            )
+        i = hits.find(1, i + 1)
+    return matches
+
+
+def memory_compare(db: Session, mine: m.Response, theirs: m.Response) -> list[Match]:
+    """
+    Load both responses' packed answers and compare them in python
+    """
+    questions = in_packed_order(theirs.survey.questions.values())
+    stmt = select(m.Response.id, m.Response.answer_bits).where(
+        m.Response.id.in_([mine.id, theirs.id])
+    )
+    bits: dict[int, bytes | None] = {rid: b for rid, b in db.execute(stmt)}
+    n = len(questions)
+    return compare(
+        questions, unpack(bits.get(mine.id), n), unpack(bits.get(theirs.id), n)
+    )
+
+
+def _visible(
+    mine: SQLColumnExpression[m.WWW], theirs: SQLColumnExpression[m.WWW]
+) -> ColumnElement[bool]:
+    return or_(*(and_(mine == a, theirs == b) for a, b in visible_combos))
+
+
+def sql_compare(db: Session, mine: m.Response, theirs: m.Response) -> list[Match]:
+    """
+    Compare in the database with a single query that only returns the
+    questions where we have something in common
+    """
+    ma = aliased(m.Answer)
+    ta = aliased(m.Answer)
+    has_flip = and_(m.Question.flip.is_not(None), m.Question.flip != "")
+    stmt = (
+        select(
+            m.Question.section,
+            m.Question.order,
+            m.Question.text,
+            m.Question.flip,
+            ma.value,
+            ma.flip,
+            ta.value,
+            ta.flip,
+        )
+        .select_from(ma)
+        .join(ta, ta.question_id == ma.question_id)
+        .join(m.Question, m.Question.id == ma.question_id)
+        .where(
+            ma.response_id == mine.id,
+            ta.response_id == theirs.id,
+            or_(
+                and_(has_flip, _visible(ma.value, ta.flip)),
+                and_(has_flip, _visible(ma.flip, ta.value)),
+                and_(~has_flip, _visible(ma.value, ta.value)),
+            ),
+        )
+        .order_by(m.Question.id)
+    )
+
+    matches: list[Match] = []
+    for section, order, text, flip, mv, mf, tv, tf in db.execute(stmt):
+        if flip:
+            if (mv, tf) in visible_combos:
+                matches.append(Match(section, order, text, flip, mv, tf))
+            if (mf, tv) in visible_combos:
+                matches.append(Match(section, order, flip, text, mf, tv))
+        elif (mv, tv) in visible_combos:
+            matches.append(Match(section, order, text, None, mv, tv))
+    return matches
+
+
+#######################################################################
+# Packed answers
+#
+# response.answer_bits holds every answer to the survey in half a byte:
+# the value's code in the low two bits, and the flip's in the high two.
+# Questions are in id order, so new questions go on the end and existing
+# bits stay valid (answers past the end are unanswered). Even positions
+# are in the low half of each byte.
+
+_NAME_CODES: dict[str | None, int] = {
+    None: 0,
+    **{www.name: code for www, code in CODES.items()},
+}
+_UNPACK: list[bytes] = [
+    bytes(b >> shift & 3 for b in range(256)) for shift in (0, 2, 4, 6)
+]
+
+
+def in_packed_order(questions: abc.Iterable[m.Question]) -> list[m.Question]:
+    return sorted(questions, key=operator.attrgetter("id"))
+
+
+def pack(answers: Vector) -> bytes:
+    nibbles = bytes(v | f << 2 for v, f in zip(answers.value, answers.flip))
+    low = nibbles[0::2]
+    high = nibbles[1::2].ljust(len(low), b"\0")
+    return bytes(lo | hi << 4 for lo, hi in zip(low, high))
+
+
+def unpack(bits: bytes | None, n: int) -> Vector:
+    """
+    The Vector for a survey's n questions (in packed order) from a
+    response's answer_bits
+    """
+    bits = (bits or b"")[: (n + 1) // 2]
+    value = bytearray(2 * len(bits))
+    flip = bytearray(2 * len(bits))
+    value[0::2] = bits.translate(_UNPACK[0])
+    flip[0::2] = bits.translate(_UNPACK[1])
+    value[1::2] = bits.translate(_UNPACK[2])
+    flip[1::2] = bits.translate(_UNPACK[3])
+    return Vector(bytes(value[:n]).ljust(n, b"\0"), bytes(flip[:n]).ljust(n, b"\0"))
+
+
+def pack_answers(
+    db: Session, response_ids: abc.Iterable[int] | Select[tuple[int]]
+) -> None:
+    """
+    Rewrite the answer_bits of every response in response_ids from the
+    answer table
+    """
+    conn = db.connection()
+    stmt = (
+        select(
+            m.Response.id,
+            # the names, without converting every row to an enum
+            type_coerce(m.Answer.value, String),
+            type_coerce(m.Answer.flip, String),
+        )
+        .join(m.Question, m.Question.survey_id == m.Response.survey_id)
+        .outerjoin(
+            m.Answer,
+            and_(
+                m.Answer.response_id == m.Response.id,
+                m.Answer.question_id == m.Question.id,
+            ),
+        )
+        .where(m.Response.id.in_(response_ids))
+        .order_by(m.Response.id, m.Question.id)
+    )
+    packed = []
+    for response_id, answers in itertools.groupby(
+        conn.execute(stmt), key=operator.itemgetter(0)
+    ):
+        value = bytearray()
+        flip = bytearray()
+        for _, v, f in answers:
+            value.append(_NAME_CODES[v])
+            flip.append(_NAME_CODES[f])
+        bits = pack(Vector(bytes(value), bytes(flip)))
+        packed.append({"response_id": response_id, "bits": bits})
+    if packed:
+        conn.execute(
+            update(m.Response)
+            .where(m.Response.id == bindparam("response_id"))
+            .values(answer_bits=bindparam("bits")),
+            packed,
+        )
+
+
+def rebuild_answer_bits(
+    engine: Engine, missing_only: bool = False, batch_size: int = 1000
+) -> int:
+    """
+    Pack the answers of existing responses, a batch at a time - all of
+    them, or only those that have never been packed. Returns the number
+    of responses.
+    """
+    stmt = select(m.Response.id).order_by(m.Response.id)
+    if missing_only:
+        stmt = stmt.where(m.Response.answer_bits.is_(None))
+    with Session(engine) as db:
+        ids = db.scalars(stmt).all()
+        for start in range(0, len(ids), batch_size):
+            pack_answers(db, ids[start : start + batch_size])
+            db.commit()
+    return len(ids)
+
+
+#######################################################################
+# Ranking
+
+
+class Scorer:
+    """
+    Count the matches between one response and many others, without
+    building the Match list - the same rules as compare(), with my side
+    of every comparison worked out once up-front
+    """
+
+    def __init__(self, questions: abc.Sequence[m.Question], mine: Vector):
+        flips = int.from_bytes(bytes(1 if q.flip else 0 for q in questions), "little")
+        self.theirs = {b for _, b in visible_combos}
+        # (my plain answers, my answers to the text side of flipped
+        # questions, my answers to the flip side), for each of their answers
+        self.mine: list[tuple[m.WWW, int, int, int]] = [
+            (
+                b,
+                _plane(mine.value, a) & ~flips,
+                _plane(mine.value, a) & flips,
+                _plane(mine.flip, a) & flips,
+            )
+            for a, b in visible_combos
+        ]
+
+    def score(self, theirs: Vector) -> int:
+        planes = {
+            b: (_plane(theirs.value, b), _plane(theirs.flip, b)) for b in self.theirs
+        }
+        forward = 0
+        backward = 0
+        for b, plain, text_side, flip_side in self.mine:
+            value, flip = planes[b]
+            forward |= (plain & value) | (text_side & flip)
+            backward |= flip_side & value
+        # one bit per lane, so this is the number of matches
+        return forward.bit_count() + backward.bit_count()
+
+
+def answer_vectors(
+    db: Session, n: int, response_ids: Select[tuple[int]]
+) -> abc.Iterator[tuple[int, Vector]]:
+    """
+    The answers of every response in response_ids (a select) to a
+    survey's n questions, in packed order - one row per response.
+    Responses with no answers are skipped.
+    """
+    stmt = (
+        select(m.Response.id, m.Response.answer_bits)
+        .where(m.Response.id.in_(response_ids), m.Response.answer_bits.is_not(None))
+        .order_by(m.Response.id)
+    )
+    for response_id, bits in db.execute(stmt):
+        yield response_id, unpack(bits, n)
+
+
+def best_matches(
+    db: Session,
+    questions: abc.Sequence[m.Question],
+    mine: Vector,
+    response_ids: Select[tuple[int]],
+    limit: int,
+) -> list[tuple[int, int]]:
+    """
+    The (response id, match count) of the `limit` responses from
+    response_ids which have the most in common with mine, best first
+    (ties go to the oldest response). questions are in packed order.
+    """
+    scorer = Scorer(questions, mine)
+    scored = (
+        (response_id, scorer.score(theirs))
+        for response_id, theirs in answer_vectors(db, len(questions), response_ids)
+    )
+    return heapq.nlargest(
+        limit,
+        ((rid, count) for rid, count in scored if count),
+        key=lambda x: (x[1], -x[0]),
+    )
+
+
+#######################################################################
+# Cache
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+
+
+cache_stats = CacheStats()
+
+CompareFn: t.TypeAlias = abc.Callable[[Session, m.Response, m.Response], list[Match]]
+
+
+def cached_compare(
+    db: Session, mine: m.Response, theirs: m.Response, compare_responses: CompareFn
+) -> list[Match]:
+    """
+    Look the comparison up in the comparison_cache table, falling back to
+    compare_responses (and saving the result) if it isn't there, or if
+    either response's answers have changed since it was saved
+    """
+    my_r, their_r = aliased(m.Response), aliased(m.Response)
+    cc = m.CachedComparison
+    # the current answers and the cached row in one query - read before
+    # comparing, so that a row saved below can only be older than the
+    # answers it's labelled with, never newer
+    row = db.execute(
+        select(
+            my_r.answer_bits,
+            their_r.answer_bits,
+            cc.my_answer_bits,
+            cc.their_answer_bits,
+            cc.matches,
+        )
+        .select_from(my_r)
+        .join(their_r, their_r.id == theirs.id)
+        .outerjoin(
+            cc, and_(cc.my_response_id == my_r.id, cc.their_response_id == their_r.id)
+        )
+        .where(my_r.id == mine.id)
+    ).one()
+    my_bits, their_bits, cached_my_bits, cached_their_bits, cached = row
+    if cached is not None and (cached_my_bits, cached_their_bits) == (
+        my_bits,
+        their_bits,
+    ):
+        cache_stats.hits += 1
+        return [
+            Match(section, order, text, flip, m.WWW[my_www], m.WWW[their_www])
+            for section, order, text, flip, my_www, their_www in json.loads(cached)
+        ]
+
+    cache_stats.misses += 1
+    matches = compare_responses(db, mine, theirs)
+    stmt = insert(m.CachedComparison).values(
+        my_response_id=mine.id,
+        their_response_id=theirs.id,
+        survey_id=theirs.survey_id,
+        matches=json.dumps(
+            [[*match[:4], match.mine.name, match.theirs.name] for match in matches]
+        ),
+        my_answer_bits=my_bits,
+        their_answer_bits=their_bits,
+    )
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[cc.my_response_id, cc.their_response_id],
+            set_={
+                "matches": stmt.excluded.matches,
+                "my_answer_bits": stmt.excluded.my_answer_bits,
+                "their_answer_bits": stmt.excluded.their_answer_bits,
+            },
+        )
+    )
+    return matches
+
+
+def invalidate_comparisons(
+    db: Session,
+    response_ids: abc.Iterable[int | None] = (),
+    survey_ids: abc.Iterable[int | None] = (),
+) -> None:
+    rids = {rid for rid in response_ids if rid is not None}
+    sids = {sid for sid in survey_ids if sid is not None}
+    if not rids and not sids:
+        return
+    db.connection().execute(
+        delete(m.CachedComparison).where(
+            or_(
+                m.CachedComparison.my_response_id.in_(rids),
+                m.CachedComparison.their_response_id.in_(rids),
+                m.CachedComparison.survey_id.in_(sids),
+            )
+        )
+    )
+
+
+@event.listens_for(Session, "before_flush")
+def _invalidate_changed_comparisons(db: Session, flush_context, instances) -> None:
+    # anything that changes an answer, a response, or a survey's questions
+    # (including save_answer, save_response, and update_question) throws
+    # away the cached comparisons that it could affect
+    response_ids: set[int | None] = set()
+    survey_ids: set[int | None] = set()
+    for obj in itertools.chain(db.new, db.dirty, db.deleted):
+        if isinstance(obj, m.Answer):
+            response_ids.add(obj.response_id)
+        elif obj in db.new:
+            # new responses and questions have nothing to invalidate
+            continue
+        elif isinstance(obj, m.Response):
+            response_ids.add(obj.id)
+        elif isinstance(obj, m.Question):
+            survey_ids.add(obj.survey_id)
+        elif isinstance(obj, m.Survey):
+            survey_ids.add(obj.id)
+    invalidate_comparisons(db, response_ids, survey_ids)
+
+
+# mapper events see every flushed change, including orphans that
+# delete-orphan removes (which never appear in Session.deleted)
+_CHANGED_RESPONSES = "compare.changed_responses"
+_MOVED_SURVEYS = "compare.moved_surveys"
+
+
+@event.listens_for(m.Answer, "after_insert")
+@event.listens_for(m.Answer, "after_update")
+@event.listens_for(m.Answer, "after_delete")
+def _answer_flushed(mapper, connection, answer: m.Answer) -> None:
+    if db := object_session(answer):
+        db.info.setdefault(_CHANGED_RESPONSES, set()).add(answer.response_id)
+
+
+@event.listens_for(m.Question, "after_delete")
+def _question_deleted(mapper, connection, question: m.Question) -> None:
+    # every later question's answers move down a place
+    if db := object_session(question):
+        db.info.setdefault(_MOVED_SURVEYS, set()).add(question.survey_id)
+
+
+@event.listens_for(Session, "after_flush")
+def _pack_changed_answers(db: Session, flush_context) -> None:
+    # the upserts in save_answer and save_answers don't flush, so they
+    # call pack_answers themselves
+    response_ids: set[int] = db.info.pop(_CHANGED_RESPONSES, set())
+    if survey_ids := db.info.pop(_MOVED_SURVEYS, set()):
+        response_ids.update(
+            db.connection().scalars(
+                select(m.Response.id).where(m.Response.survey_id.in_(survey_ids))
+            )
+        )
+    if response_ids:
+        pack_answers(db, response_ids)
@@ -0,0 +1,107 @@
+import hashlib
+import math
+import re
+import typing as t
+
+from graphql import GraphQLError
+from strawberry.extensions import ParserCache, ValidationCache
+from strawberry.http import GraphQLRequestData
+from strawberry.http.async_base_view import AsyncHTTPRequestAdapter
+from strawberry.types import ExecutionResult
+
+from .cache import TTLCache
+
+DEFAULT_DOCUMENT_CACHE_SIZE = 256
+DEFAULT_PERSISTED_QUERIES_SIZE = 1024
+
+# how many distinct queries to keep parsed and validated
+_document_cache_size = DEFAULT_DOCUMENT_CACHE_SIZE
+# sha256 of query text -> query text
+persisted_queries = TTLCache[str, str](
+    max_size=DEFAULT_PERSISTED_QUERIES_SIZE, ttl=math.inf
+)
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def configure(
+    document_cache_size: int = DEFAULT_DOCUMENT_CACHE_SIZE,
+    persisted_queries_size: int = DEFAULT_PERSISTED_QUERIES_SIZE,
+) -> None:
+    global _document_cache_size
+    _document_cache_size = document_cache_size
+    persisted_queries.max_size = persisted_queries_size
+    persisted_queries.clear()
+
+
+class PersistedQueryNotFound(GraphQLError):
+    def __init__(self):
+        super().__init__(
+            "PersistedQueryNotFound",
+            extensions={"code": "PERSISTED_QUERY_NOT_FOUND"},
+        )
+
+
+def resolve_persisted_query(request_data: GraphQLRequestData) -> None:
+    """
+    Handle the "persistedQuery" request extension: a request with a hash
+    and no query gets the query that was sent with that hash before, and
+    a request with both registers the query for next time
+    """
+    persisted = (request_data.extensions or {}).get("persistedQuery")
+    if persisted is None:
+        return
+    if not isinstance(persisted, dict) or persisted.get("version") != 1:
+        raise GraphQLError("Unsupported persisted query version")
+    sha = persisted.get("sha256Hash")
+    if not isinstance(sha, str) or not _SHA256_RE.match(sha):
+        raise GraphQLError("Invalid persisted query hash")
+
+    if request_data.query is None:
+        query = persisted_queries.get(sha)
+        if query is None:
+            raise PersistedQueryNotFound()
+        request_data.query = query
+    else:
+        if hashlib.sha256(request_data.query.encode()).hexdigest() != sha:
+            raise GraphQLError("Provided sha does not match query")
+        persisted_queries.set(sha, request_data.query)
+
+
+def parser_cache() -> ParserCache:
+    # strawberry keeps one cache per size, shared by every request
+    return ParserCache(maxsize=_document_cache_size)
+
+
+def validation_cache() -> ValidationCache:
+    return ValidationCache(maxsize=_document_cache_size)
+
+
+class PersistedQueries:
+    """
+    Mixin for strawberry's async views, which fills in persisted queries
+    before they are executed
+    """
+
+    async def execute_single(
+        self,
+        request: t.Any,
+        request_adapter: AsyncHTTPRequestAdapter,
+        sub_response: t.Any,
+        context: t.Any,
+        root_value: t.Any | None,
+        request_data: GraphQLRequestData,
+    ) -> ExecutionResult:
+        try:
+            resolve_persisted_query(request_data)
+        except GraphQLError as e:
+            return ExecutionResult(data=None, errors=[e])
+        # the view this is mixed into has one
+        return await super().execute_single(  # ty: ignore[unresolved-attribute]
+            request=request,
+            request_adapter=request_adapter,
+            sub_response=sub_response,
+            context=context,
+            root_value=root_value,
+            request_data=request_data,
+        )
@@ -0,0 +1,125 @@
+import concurrent.futures
+import dataclasses
+import os
+import threading
+import time
+import typing as t
+
+from sqlalchemy import Engine, exc, select
+from sqlalchemy.pool import QueuePool
+
+from . import models as m
+
+
+@dataclasses.dataclass
+class Thresholds:
+    # give up on the database round-trip after this long
+    timeout: float = 1.0
+    # re-use a result for this long, so that health checks don't add load
+    cache_seconds: float = 2.0
+    # a round-trip slower than this is "degraded"
+    slow_ms: float = 100.0
+    # a pool this full is "degraded", completely full is "unhealthy"
+    pool_degraded: float = 0.8
+    # a WAL this big means checkpoints aren't keeping up
+    max_wal_bytes: int = 64 * 1024 * 1024
+
+
+class HealthCheck:
+    """
+    Check whether this worker can usefully serve requests: can it get a
+    connection and run a query quickly, is the pool close to exhausted,
+    and is the SQLite WAL growing without being checkpointed
+    """
+
+    def __init__(self, engine: Engine, max_overflow: int, thresholds: Thresholds):
+        self.engine = engine
+        self.max_overflow = max_overflow
+        self.thresholds = thresholds
+        # one probe at a time - if it's stuck, later checks report that
+        # rather than piling up more stuck threads
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="health"
+        )
+        self._running: concurrent.futures.Future | None = None
+        self._lock = threading.Lock()
+        self._result: dict[str, t.Any] | None = None
+        self._checked_at = 0.0
+
+    def _round_trip(self) -> float:
+        start = time.perf_counter()
+        with self.engine.connect() as conn:
+            conn.execute(select(m.User.id).limit(1)).all()
+        return (time.perf_counter() - start) * 1000
+
+    def _check_db(self) -> dict[str, t.Any]:
+        with self._lock:
+            if self._running is None or self._running.done():
+                self._running = self._executor.submit(self._round_trip)
+            running = self._running
+        try:
+            ms = running.result(timeout=self.thresholds.timeout)
+        except concurrent.futures.TimeoutError:
+            return {"status": "unhealthy", "error": "timeout"}
+        except exc.SQLAlchemyError as e:
+            return {"status": "unhealthy", "error": str(getattr(e, "orig", None) or e)}
+        status = "degraded" if ms > self.thresholds.slow_ms else "healthy"
+        return {"status": status, "ms": round(ms, 3)}
+
+    def _check_pool(self) -> dict[str, t.Any] | None:
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool):
+            return None
+        capacity = pool.size() + max(self.max_overflow, 0)
+        checked_out = pool.checkedout()
+        saturation = checked_out / capacity if capacity else 0.0
+        if saturation >= 1:
+            status = "unhealthy"
+        elif saturation >= self.thresholds.pool_degraded:
+            status = "degraded"
+        else:
+            status = "healthy"
+        return {
+            "status": status,
+            "checked_out": checked_out,
+            "capacity": capacity,
+            "saturation": round(saturation, 3),
+        }
+
+    def _check_wal(self) -> dict[str, t.Any] | None:
+        url = self.engine.url
+        if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+            return None
+        try:
+            size = os.path.getsize(f"{url.database}-wal")
+        except FileNotFoundError:
+            size = 0
+        status = "degraded" if size > self.thresholds.max_wal_bytes else "healthy"
+        return {"status": status, "bytes": size}
+
+    def _probe(self) -> dict[str, t.Any]:
+        checks = {
+            name: result
+            for name, result in [
+                ("db", self._check_db()),
+                ("pool", self._check_pool()),
+                ("wal", self._check_wal()),
+            ]
+            if result is not None
+        }
+        statuses = {c["status"] for c in checks.values()}
+        if "unhealthy" in statuses:
+            status = "unhealthy"
+        elif "degraded" in statuses:
+            status = "degraded"
+        else:
+            status = "healthy"
+        return {"status": status, "checks": checks}
+
+    def check(self) -> dict[str, t.Any]:
+        now = time.monotonic()
+        result = self._result
+        if result is None or now - self._checked_at >= self.thresholds.cache_seconds:
+            result = self._result = self._probe()
+            self._checked_at = now = time.monotonic()
+        return {**result, "age": round(now - self._checked_at, 3)}
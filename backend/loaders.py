@@ -0,0 +1,126 @@
+import typing as t
+from collections import abc
+
+from sqlalchemy import and_, case, distinct, exists, func, or_, select
+from sqlalchemy.orm import Session, aliased
+from strawberry.dataloader import DataLoader
+
+from . import models as m
+from .async_db import run
+
+
+class SurveyCounts(t.NamedTuple):
+    friend_responses: int
+    other_responses: int
+    unanswered_questions: int
+
+
+def survey_counts(
+    db: Session, survey_ids: abc.Collection[int], user_id: int
+) -> dict[int, SurveyCounts]:
+    """
+    Count the responses (split into mine / friends' / other people's) and
+    the questions that I haven't answered yet, for many surveys in one query
+    """
+    is_friend = and_(
+        m.Friendship.confirmed,
+        or_(
+            and_(
+                m.Friendship.friend_a_id == user_id,
+                m.Friendship.friend_b_id == m.Response.user_id,
+            ),
+            and_(
+                m.Friendship.friend_b_id == user_id,
+                m.Friendship.friend_a_id == m.Response.user_id,
+            ),
+        ),
+    )
+    mine = aliased(m.Response)
+    my_response_id = (
+        select(mine.id)
+        .where(mine.survey_id == m.Survey.id, mine.user_id == user_id)
+        .scalar_subquery()
+    )
+    unanswered = (
+        select(func.count(m.Question.id))
+        .where(
+            m.Question.survey_id == m.Survey.id,
+            ~exists().where(
+                m.Answer.response_id == my_response_id,
+                m.Answer.question_id == m.Question.id,
+            ),
+        )
+        .scalar_subquery()
+    )
+    stmt = (
+        select(
+            m.Survey.id,
+            func.count(distinct(m.Response.id)),
+            func.count(
+                distinct(case((m.Friendship.friend_a_id.is_not(None), m.Response.id)))
+            ),
+            func.count(distinct(case((m.Response.user_id == user_id, m.Response.id)))),
+            unanswered,
+        )
+        .outerjoin(m.Response, m.Response.survey_id == m.Survey.id)
+        .outerjoin(m.Friendship, is_friend)
+        .where(m.Survey.id.in_(survey_ids))
+        .group_by(m.Survey.id)
+    )
+    return {
+        survey_id: SurveyCounts(
+            friend_responses=friends,
+            other_responses=total - friends - mine,
+            unanswered_questions=unanswered,
+        )
+        for survey_id, total, friends, mine, unanswered in db.execute(stmt)
+    }
+
+
+class Loaders:
+    """
+    Request-scoped DataLoaders, so that resolvers for many objects in a
+    list can share a single query - through async_db.run, in case db is
+    an AsyncSession's sync_session
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+        self.survey_counts = DataLoader[tuple[int, int], SurveyCounts](
+            load_fn=self._load_survey_counts
+        )
+        self.my_response = DataLoader[tuple[int, int], m.Response | None](
+            load_fn=self._load_my_response
+        )
+
+    async def _load_survey_counts(
+        self, keys: abc.Sequence[tuple[int, int]]
+    ) -> list[SurveyCounts]:
+        return await run(self.db, self._survey_counts, keys)
+
+    def _survey_counts(self, keys: abc.Sequence[tuple[int, int]]) -> list[SurveyCounts]:
+        counts: dict[tuple[int, int], SurveyCounts] = {}
+        for user_id in {user_id for _, user_id in keys}:
+            survey_ids = [sid for sid, uid in keys if uid == user_id]
+            for survey_id, c in survey_counts(self.db, survey_ids, user_id).items():
+                counts[(survey_id, user_id)] = c
+        return [counts[key] for key in keys]
+
+    async def _load_my_response(
+        self, keys: abc.Sequence[tuple[int, int]]
+    ) -> list[m.Response | None]:
+        return await run(self.db, self._my_response, keys)
+
+    def _my_response(
+        self, keys: abc.Sequence[tuple[int, int]]
+    ) -> list[m.Response | None]:
+        responses: dict[tuple[int, int], m.Response] = {}
+        for user_id in {user_id for _, user_id in keys}:
+            survey_ids = [sid for sid, uid in keys if uid == user_id]
+            for r in self.db.scalars(
+                select(m.Response).where(
+                    m.Response.user_id == user_id, m.Response.survey_id.in_(survey_ids)
+                )
+            ):
+                responses[(r.survey_id, user_id)] = r
+        return [responses.get(key) for key in keys]
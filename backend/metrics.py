@@ -0,0 +1,377 @@
+"""
+Prometheus-style metrics, without a dependency on prometheus_client.
+
+Each process keeps its own histograms in memory (recording is a bisect and
+a few additions under a lock), and every few seconds writes a snapshot of
+them to METRICS_DIR. /metrics merges the snapshots from every worker, so it
+doesn't matter which gunicorn worker answers the scrape.
+
+Snapshot files are named by a random id per process, rather than the pid,
+which might be reused. When a worker's process has gone, /metrics folds its
+last snapshot into a running total and removes it.
+"""
+
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+import typing as t
+from collections import abc
+
+from graphql import GraphQLResolveInfo, get_named_type, is_leaf_type
+from sqlalchemy import Engine
+from strawberry.extensions import SchemaExtension
+
+from . import compare
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# operation names come from the client, so don't let them make new labels
+# forever
+MAX_LABELS = 200
+SNAPSHOT_INTERVAL = 5.0
+# gauges from workers that haven't written a snapshot for this long are
+# assumed to be dead; their counters and histograms are kept, so that
+# totals never go backwards
+STALE_AFTER = 60.0
+# where the counters and histograms of workers that have exited end up
+TOTALS_FILE = "totals.json"
+
+Labels: t.TypeAlias = tuple[tuple[str, str], ...]
+Sample: t.TypeAlias = tuple[str, str, Labels, float]  # name, type, labels, value
+
+
+class Histogram:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.series: dict[Labels, list[float]] = {}
+
+    def observe(self, labels: Labels, value: float) -> None:
+        with _lock:
+            series = self.series.get(labels)
+            if series is None:
+                if len(self.series) >= MAX_LABELS:
+                    labels = tuple((k, "other") for k, _ in labels)
+                series = self.series.setdefault(labels, [0.0] * (len(BUCKETS) + 3))
+            # one count per bucket, then +Inf, then sum, then count
+            series[bisect.bisect_left(BUCKETS, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+
+operation_seconds = Histogram(
+    "graphql_operation_seconds", "Time taken by GraphQL operations"
+)
+resolver_seconds = Histogram(
+    "graphql_resolver_seconds", "Time taken by GraphQL resolvers, per field"
+)
+HISTOGRAMS = [operation_seconds, resolver_seconds]
+
+# functions that report the current value of gauges and counters, called
+# when a snapshot is taken rather than on every request
+collectors: dict[str, abc.Callable[[], abc.Iterable[Sample]]] = {}
+
+_lock = threading.Lock()
+_directory: str | None = None
+_last_snapshot = 0.0
+
+
+def _new_process_id() -> None:
+    global _process_id
+    _process_id = os.urandom(8).hex()
+
+
+_process_id = ""
+_new_process_id()
+# gunicorn forks its workers, which would otherwise all share one id
+os.register_at_fork(after_in_child=_new_process_id)
+
+
+def configure(directory: str | None) -> None:
+    global _directory
+    _directory = directory
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+def reset() -> None:
+    global _last_snapshot
+    _last_snapshot = 0.0
+    with _lock:
+        for h in HISTOGRAMS:
+            h.series.clear()
+
+
+def track_pool(engine: Engine) -> None:
+    pool = engine.pool
+
+    def collect() -> abc.Iterable[Sample]:
+        # not every pool class (eg sqlite's SingletonThreadPool) has these
+        for name, method in [
+            ("db_pool_size", "size"),
+            ("db_pool_checked_out", "checkedout"),
+            ("db_pool_overflow", "overflow"),
+        ]:
+            fn = getattr(pool, method, None)
+            if callable(fn):
+                yield name, "gauge", (), float(fn())
+
+    collectors["pool"] = collect
+
+
+def _collect_comparison_cache() -> abc.Iterable[Sample]:
+    yield "comparison_cache_hits_total", "counter", (), compare.cache_stats.hits
+    yield "comparison_cache_misses_total", "counter", (), compare.cache_stats.misses
+
+
+collectors["comparison_cache"] = _collect_comparison_cache
+
+
+#######################################################################
+# Snapshots
+
+
+def snapshot() -> dict[str, t.Any]:
+    with _lock:
+        histograms = {
+            h.name: [
+                [list(labels), list(series)] for labels, series in h.series.items()
+            ]
+            for h in HISTOGRAMS
+        }
+    samples = [
+        [name, kind, list(labels), value]
+        for collect in collectors.values()
+        for name, kind, labels, value in collect()
+    ]
+    return {
+        "time": time.time(),
+        "pid": os.getpid(),
+        "histograms": histograms,
+        "samples": samples,
+    }
+
+
+def _snapshot_path() -> str:
+    assert _directory
+    return os.path.join(_directory, f"{_process_id}.json")
+
+
+def write_snapshot() -> None:
+    global _last_snapshot
+    _last_snapshot = time.monotonic()
+    if not _directory:
+        return
+    path = _snapshot_path()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as fp:
+        json.dump(snapshot(), fp)
+    os.replace(tmp, path)
+
+
+def maybe_write_snapshot() -> None:
+    if time.monotonic() - _last_snapshot >= SNAPSHOT_INTERVAL:
+        write_snapshot()
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # pragma: no cover
+        pass
+    return True
+
+
+def _read_snapshots() -> list[dict[str, t.Any]]:
+    # this process's own numbers are always fresh, other workers' come
+    # from their last snapshot
+    snapshots = [snapshot()]
+    if not _directory:
+        return snapshots
+    me = os.path.basename(_snapshot_path())
+    # the lock stops another worker folding a snapshot into the totals
+    # between us reading the one and the other
+    with open(os.path.join(_directory, "lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        totals: dict[str, t.Any] | None = None
+        dead: list[tuple[str, dict[str, t.Any]]] = []
+        for name in os.listdir(_directory):
+            if not name.endswith(".json") or name == me:
+                continue
+            try:
+                with open(os.path.join(_directory, name)) as fp:
+                    snap = json.load(fp)
+            except OSError, ValueError:  # pragma: no cover
+                # half-written, or removed while we were looking
+                continue
+            if name == TOTALS_FILE:
+                totals = snap
+            elif "pid" not in snap or not _is_running(snap["pid"]):
+                # including snapshots from before they had a pid
+                dead.append((name, snap))
+            else:
+                snapshots.append(snap)
+        if dead:
+            totals = _fold([snap for _, snap in dead] + ([totals] if totals else []))
+            path = os.path.join(_directory, TOTALS_FILE)
+            with open(f"{path}.tmp", "w") as fp:
+                json.dump(totals, fp)
+            os.replace(f"{path}.tmp", path)
+            for name, _ in dead:
+                os.remove(os.path.join(_directory, name))
+        if totals:
+            snapshots.append(totals)
+    return snapshots
+
+
+def _fold(snapshots: list[dict[str, t.Any]]) -> dict[str, t.Any]:
+    """
+    One snapshot with the sum of the counters and histograms of several
+    """
+    histograms, samples = _merge(snapshots, gauges=False)
+    return {
+        "time": 0,
+        "histograms": {
+            name: [[list(labels), series] for labels, series in merged.items()]
+            for name, merged in histograms.items()
+        },
+        "samples": [
+            [name, kind, list(labels), value]
+            for (name, kind, labels), value in samples.items()
+        ],
+    }
+
+
+def _merge(
+    snapshots: list[dict[str, t.Any]], gauges: bool = True
+) -> tuple[dict[str, dict[Labels, list[float]]], dict[tuple[str, str, Labels], float]]:
+    """
+    Add up the histograms and samples of several snapshots - with gauges
+    only from workers which have written a snapshot recently
+    """
+    now = time.time()
+    histograms: dict[str, dict[Labels, list[float]]] = {}
+    for h in HISTOGRAMS:
+        merged = histograms[h.name] = {}
+        for snap in snapshots:
+            for labels, series in snap["histograms"].get(h.name, []):
+                key = tuple((k, v) for k, v in labels)
+                if key in merged:
+                    merged[key] = [a + b for a, b in zip(merged[key], series)]
+                else:
+                    merged[key] = list(series)
+
+    samples: dict[tuple[str, str, Labels], float] = {}
+    for snap in snapshots:
+        live = gauges and now - snap["time"] < STALE_AFTER
+        for name, kind, labels, value in snap["samples"]:
+            if kind == "gauge" and not live:
+                continue
+            key = (name, kind, tuple((k, v) for k, v in labels))
+            samples[key] = samples.get(key, 0.0) + value
+    return histograms, samples
+
+
+#######################################################################
+# Exposition
+
+
+def _format_labels(labels: abc.Iterable[abc.Sequence[str]]) -> str:
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+def render() -> str:
+    """
+    Merge every worker's snapshot into the Prometheus text format
+    """
+    histograms, totals = _merge(_read_snapshots())
+    lines: list[str] = []
+
+    for h in HISTOGRAMS:
+        merged = histograms[h.name]
+        lines.append(f"# HELP {h.name} {h.help}")
+        lines.append(f"# TYPE {h.name} histogram")
+        for labels, series in sorted(merged.items()):
+            cumulative = 0.0
+            for bound, count in zip([*BUCKETS, "+Inf"], series[:-2]):
+                cumulative += count
+                le = _format_labels([*labels, ("le", str(bound))])
+                lines.append(f"{h.name}_bucket{le} {_format_value(cumulative)}")
+            lines.append(f"{h.name}_sum{_format_labels(labels)} {series[-2]!r}")
+            lines.append(
+                f"{h.name}_count{_format_labels(labels)} {_format_value(series[-1])}"
+            )
+
+    seen: set[str] = set()
+    for (name, kind, labels), value in sorted(totals.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+#######################################################################
+# GraphQL
+
+
+class Metrics(SchemaExtension):
+    """
+    Time every operation, and every resolver which returns an object
+    (scalar fields are nearly free, and there are a lot of them)
+    """
+
+    _timed: t.ClassVar[dict[tuple[str, str], bool]] = {}
+
+    def on_operation(self):
+        start = time.perf_counter()
+        yield
+        ctx = self.execution_context
+        try:
+            kind = ctx.operation_type.value
+        except RuntimeError:
+            # the document couldn't be parsed
+            kind = "unknown"
+        operation_seconds.observe(
+            (("operation", ctx.operation_name or ""), ("type", kind)),
+            time.perf_counter() - start,
+        )
+        maybe_write_snapshot()
+
+    def _should_time(self, info: GraphQLResolveInfo) -> bool:
+        key = (info.parent_type.name, info.field_name)
+        timed = self._timed.get(key)
+        if timed is None:
+            timed = not is_leaf_type(get_named_type(info.return_type))
+            self._timed[key] = timed
+        return timed
+
+    def resolve(self, _next, root, info: GraphQLResolveInfo, *args, **kwargs):
+        if not self._should_time(info):
+            return _next(root, info, *args, **kwargs)
+        labels = (("field", f"{info.parent_type.name}.{info.field_name}"),)
+        start = time.perf_counter()
+        result = _next(root, info, *args, **kwargs)
+        if hasattr(result, "__await__"):
+            return self._resolve_async(result, labels, start)
+        resolver_seconds.observe(labels, time.perf_counter() - start)
+        return result
+
+    async def _resolve_async(self, result: t.Awaitable, labels: Labels, start: float):
+        try:
+            return await result
+        finally:
+            resolver_seconds.observe(labels, time.perf_counter() - start)
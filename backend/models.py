@@ -1,8 +1,19 @@
 import enum
 import typing as t
 
-import bcrypt
-from sqlalchemy import Enum, ForeignKey
+from sqlalchemy import (
+    Connection,
+    Engine,
+    Enum,
+    ForeignKey,
+    Index,
+    LargeBinary,
+    delete,
+    func,
+    inspect,
+    select,
+    text,
+)
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -11,6 +22,9 @@ from sqlalchemy.orm import (
     mapped_column,
     relationship,
 )
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from . import passwords
 
 SECURE: bool = True
 
@@ -72,25 +86,40 @@ class User(Base):
         "Friendship", foreign_keys=[Friendship.friend_a_id], back_populates="friend_a"
     )
 
-    def __init__(self, username: str, password: str, email: str = ""):
+    def __init__(self, username: str, password: str | None = None, email: str = ""):
         self.username = username
         self.email = email
-        self.set_password(password)
+        if password is not None:
+            self.set_password(password)
 
     def set_password(self, password: str) -> None:
-        given = password.encode()
         if SECURE:  # pragma: no cover
-            self.password = bcrypt.hashpw(given, bcrypt.gensalt()).decode()
+            self.password = passwords.hash_password(password)
         else:
             self.password = password
 
     def check_password(self, password: str) -> bool:
-        given = password.encode()
-        current = self.password.encode()
         if SECURE:  # pragma: no cover
-            return bcrypt.hashpw(given, current) == current
+            return passwords.verify_password(password, self.password)
         else:
-            return given == current
+            return password == self.password
+
+    async def set_password_async(self, password: str) -> None:
+        if SECURE:  # pragma: no cover
+            self.password = await passwords.hash_password_async(password)
+        else:
+            self.password = password
+
+    async def check_password_async(self, password: str) -> bool:
+        if SECURE:  # pragma: no cover
+            return await passwords.check_password_async(
+                self.id, password, self.password
+            )
+        else:
+            return password == self.password
+
+    def password_needs_rehash(self) -> bool:
+        return SECURE and passwords.needs_rehash(self.password)
 
     @property
     def friends(self) -> t.Iterator[User]:
@@ -105,11 +134,15 @@ class User(Base):
         return f"<User {self.username}>"
 
 
+# usernames are looked up case-insensitively, which can't use the plain index
+Index("ix_user_username_lower", func.lower(User.username))
+
+
 class Question(Base):
     __tablename__ = "question"
 
     id: Mapped[int] = mapped_column("id", primary_key=True)
-    survey_id: Mapped[int] = mapped_column(ForeignKey("survey.id"), index=True)
+    survey_id: Mapped[int] = mapped_column(ForeignKey("survey.id"))
     order: Mapped[float] = mapped_column(default=0.0)
     section: Mapped[str] = mapped_column(default="")
     text: Mapped[str]
@@ -119,6 +152,12 @@ class Question(Base):
     survey: Mapped[Survey] = relationship("Survey")
 
 
+# a survey's questions in display order (ties broken by the implicit id),
+# straight from the index without sorting - and, as survey_id comes first,
+# any other lookup by survey
+Index("ix_question_survey_order", Question.survey_id, Question.order)
+
+
 class Survey(Base):
     __tablename__ = "survey"
 
@@ -166,6 +205,10 @@ class Response(Base):
         ForeignKey("survey.id"), nullable=False, index=True
     )
     privacy: Mapped[Privacy] = mapped_column(Enum(Privacy), default=Privacy.FRIENDS)
+    # every answer, packed by compare.pack_answers whenever they're saved
+    answer_bits: Mapped[bytes | None] = mapped_column(
+        LargeBinary, default=None, deferred=True
+    )
 
     owner: Mapped[User] = relationship("User", lazy="joined")
     survey: Mapped[Survey] = relationship("Survey", back_populates="responses")
@@ -176,6 +219,79 @@ class Response(Base):
     )
 
 
+# one response per user per survey - the save paths upsert against this
+Index("ix_response_survey_user", Response.survey_id, Response.user_id, unique=True)
+
+
+class CachedComparison(Base):
+    __tablename__ = "comparison_cache"
+
+    my_response_id: Mapped[int] = mapped_column(
+        ForeignKey("response.id"), primary_key=True
+    )
+    their_response_id: Mapped[int] = mapped_column(
+        ForeignKey("response.id"), primary_key=True, index=True
+    )
+    survey_id: Mapped[int] = mapped_column(ForeignKey("survey.id"), index=True)
+    matches: Mapped[str]
+    # both responses' answer_bits when the comparison was made - a row is
+    # only used while they still match, so a comparison made from answers
+    # that have since changed can never be served, however it raced
+    my_answer_bits: Mapped[bytes | None] = mapped_column(LargeBinary, default=None)
+    their_answer_bits: Mapped[bytes | None] = mapped_column(LargeBinary, default=None)
+
+
+def upgrade_schema(engine: Engine) -> None:
+    """
+    Create any tables that are missing, and any columns and indexes that
+    are missing from existing tables (which create_all skips)
+    """
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        _add_missing_columns(conn)
+        _remove_duplicate_responses(conn)
+        # reflection can't see expression indexes, so let the database check
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+        for name in _OBSOLETE_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+# indexes that older versions created, which newer ones cover
+_OBSOLETE_INDEXES = ["ix_question_survey_id"]
+
+
+def _add_missing_columns(conn: Connection) -> None:
+    # columns added to existing tables are nullable, so that existing rows
+    # don't need a value
+    inspector = inspect(conn)
+    preparer = conn.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(
+                    text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}")
+                )
+
+
+def _remove_duplicate_responses(conn: Connection) -> None:
+    # older versions could race and save two responses for the same user
+    # and survey - keep the first, which is the one that they've been
+    # seeing, so that ix_response_survey_user can be created
+    first = select(func.min(Response.id)).group_by(Response.survey_id, Response.user_id)
+    duplicates = select(Response.id).where(Response.id.not_in(first))
+    for table, column in [
+        (Answer, Answer.response_id),
+        (CachedComparison, CachedComparison.my_response_id),
+        (CachedComparison, CachedComparison.their_response_id),
+        (Response, Response.id),
+    ]:
+        conn.execute(delete(table).where(column.in_(duplicates)))
+
+
 def populate_example_data(db: Session):
     users: list[User] = []
     for name in ["Alice", "Bob", "Charlie", "Dave", "Evette", "Frank"]:
@@ -0,0 +1,115 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import re
+
+import bcrypt
+
+from .cache import TTLCache
+
+# bcrypt releases the GIL while hashing, so a few threads are enough to
+# keep logins from blocking the event loop that runs the resolvers
+DEFAULT_WORKERS = 4
+DEFAULT_ROUNDS = 12
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 60.0
+
+_workers = DEFAULT_WORKERS
+_rounds = DEFAULT_ROUNDS
+_pool: concurrent.futures.ThreadPoolExecutor | None = None
+
+# Passwords which were checked recently, so that a burst of logins doesn't
+# cost a full bcrypt round each. Entries are keyed by an HMAC with a secret
+# that never leaves this process, so the cache holds nothing that could be
+# used to recover a password, and changing the hash makes old entries miss.
+_secret = os.urandom(32)
+_verified = TTLCache[bytes, bool](max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL)
+
+_BCRYPT_RE = re.compile(r"^\$(2[abxy])\$(\d\d)\$")
+
+
+def configure(
+    workers: int = DEFAULT_WORKERS,
+    rounds: int = DEFAULT_ROUNDS,
+    cache_size: int = DEFAULT_CACHE_SIZE,
+    cache_ttl: float = DEFAULT_CACHE_TTL,
+) -> None:
+    """
+    Set how many passwords can be hashed at once (requests beyond that
+    queue up for a free worker), the bcrypt cost for new hashes, and how
+    many verified passwords to remember for how long
+    """
+    global _workers, _rounds, _pool
+    if workers < 1:
+        raise ValueError("workers must be positive")
+    if not 4 <= rounds <= 31:
+        raise ValueError("rounds must be between 4 and 31")
+    if _pool is not None and workers != _workers:
+        _pool.shutdown(wait=False)
+        _pool = None
+    _workers = workers
+    _rounds = rounds
+    _verified.max_size = cache_size
+    _verified.ttl = cache_ttl
+    _verified.clear()
+
+
+def _executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=_workers, thread_name_prefix="bcrypt"
+        )
+    return _pool
+
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(_rounds)).decode()
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    try:
+        return bcrypt.checkpw(password.encode(), hashed.encode())
+    except ValueError:
+        # not a bcrypt hash at all
+        return False
+
+
+def needs_rehash(hashed: str) -> bool:
+    """
+    Hashes made with an older bcrypt variant or a different cost should be
+    replaced the next time we see the plain-text password
+    """
+    match = _BCRYPT_RE.match(hashed)
+    return not match or match.group(1) != "2b" or int(match.group(2)) != _rounds
+
+
+async def hash_password_async(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor(), hash_password, password)
+
+
+async def verify_password_async(password: str, hashed: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor(), verify_password, password, hashed)
+
+
+def _cache_key(user_id: int, password: str, hashed: str) -> bytes:
+    msg = b"\0".join([str(user_id).encode(), password.encode(), hashed.encode()])
+    return hmac.new(_secret, msg, hashlib.sha256).digest()
+
+
+async def check_password_async(user_id: int, password: str, hashed: str) -> bool:
+    """
+    Verify a user's password, skipping bcrypt if the same password was
+    verified against the same hash recently. Failures are never cached.
+    """
+    key = _cache_key(user_id, password, hashed)
+    if key in _verified:
+        return True
+    if await verify_password_async(password, hashed):
+        _verified.set(key, True)
+        return True
+    return False
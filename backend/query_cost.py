@@ -0,0 +1,208 @@
+import dataclasses
+from collections import abc
+
+from graphql import (
+    ExecutionResult,
+    FieldNode,
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    GraphQLObjectType,
+    GraphQLSchema,
+    InlineFragmentNode,
+    IntValueNode,
+    OperationDefinitionNode,
+    SelectionSetNode,
+    VariableNode,
+    get_named_type,
+    get_nullable_type,
+    is_list_type,
+    is_object_type,
+)
+from graphql.utilities import get_operation_ast
+from strawberry.extensions import SchemaExtension
+
+
+@dataclasses.dataclass
+class Limits:
+    # operations costing more than this are rejected before they run
+    max_cost: int = 1000
+    max_depth: int = 10
+    # fields which return an object cost this much, scalars are free
+    default_cost: int = 1
+    # how many items we assume an unpaginated list returns
+    default_list_size: int = 20
+    # paginated fields without a `first` argument
+    default_page_size: int = 20
+    # paginate() never returns more than this, whatever `first` asks for
+    max_page_size: int = 100
+    # overrides, keyed by "Type.field"
+    field_costs: dict[str, int] = dataclasses.field(
+        default_factory=lambda: {
+            "Response.comparison": 10,
+            "Survey.stats": 2,
+            "Survey.bestMatches": 10,
+        }
+    )
+    list_sizes: dict[str, int] = dataclasses.field(
+        default_factory=lambda: {
+            "Survey.questions": 100,
+            "Response.answers": 100,
+            "Response.comparison": 100,
+            "Survey.bestMatches": 10,
+            "Survey.responses": 50,
+        }
+    )
+
+
+LIMITS = Limits()
+
+
+def configure(**kwargs) -> None:
+    """
+    Override the default limits, eg from app config -
+    field_costs and list_sizes are merged with the defaults
+    """
+    global LIMITS
+    defaults = Limits()
+    field_costs = {**defaults.field_costs, **kwargs.pop("field_costs", {})}
+    list_sizes = {**defaults.list_sizes, **kwargs.pop("list_sizes", {})}
+    LIMITS = Limits(**kwargs, field_costs=field_costs, list_sizes=list_sizes)
+
+
+class QueryTooExpensive(GraphQLError):
+    pass
+
+
+class _Estimator:
+    def __init__(
+        self,
+        fragments: dict[str, FragmentDefinitionNode],
+        variables: abc.Mapping[str, object],
+        limits: Limits,
+        schema: GraphQLSchema,
+    ):
+        self.fragments = fragments
+        self.variables = variables
+        self.limits = limits
+        self.schema = schema
+
+    def _int_arg(self, node: FieldNode, name: str) -> int | None:
+        for arg in node.arguments or ():
+            if arg.name.value != name:
+                continue
+            if isinstance(arg.value, IntValueNode):
+                return int(arg.value.value)
+            if isinstance(arg.value, VariableNode):
+                value = self.variables.get(arg.value.name.value)
+                return value if isinstance(value, int) else None
+        return None
+
+    def _fields(
+        self, parent: GraphQLObjectType, selections: SelectionSetNode
+    ) -> abc.Iterator[tuple[GraphQLObjectType, FieldNode]]:
+        for sel in selections.selections:
+            if isinstance(sel, FieldNode):
+                yield parent, sel
+            elif isinstance(sel, FragmentSpreadNode):
+                fragment = self.fragments.get(sel.name.value)
+                if fragment:
+                    yield from self._fields(
+                        self._narrow(parent, fragment.type_condition),
+                        fragment.selection_set,
+                    )
+            elif isinstance(sel, InlineFragmentNode):
+                yield from self._fields(
+                    self._narrow(parent, sel.type_condition), sel.selection_set
+                )
+
+    def _narrow(self, parent: GraphQLObjectType, condition) -> GraphQLObjectType:
+        if condition is None:
+            return parent
+        narrowed = self.schema.get_type(condition.name.value)
+        return narrowed if is_object_type(narrowed) else parent  # type: ignore
+
+    def cost(
+        self, parent: GraphQLObjectType, selections: SelectionSetNode, depth: int
+    ) -> int:
+        if depth > self.limits.max_depth:
+            raise QueryTooExpensive(
+                f"Query is too deeply nested (max depth {self.limits.max_depth})"
+            )
+        total = 0
+        for owner, node in self._fields(parent, selections):
+            name = node.name.value
+            field = owner.fields.get(name)
+            if name.startswith("__") or field is None:
+                # introspection, or something that validation will reject
+                continue
+            key = f"{owner.name}.{name}"
+            child_type = get_named_type(field.type)
+            if not node.selection_set or not is_object_type(child_type):
+                total += self.limits.field_costs.get(key, 0)
+                continue
+
+            own = self.limits.field_costs.get(key, self.limits.default_cost)
+            if "first" in field.args:
+                # a connection - edges will be multiplied by the page size
+                size = self._int_arg(node, "first")
+                if size is None:
+                    size = self.limits.default_page_size
+                size = max(1, min(size, self.limits.max_page_size))
+            elif is_list_type(get_nullable_type(field.type)) and name != "edges":
+                size = self.limits.list_sizes.get(key, self.limits.default_list_size)
+            else:
+                size = 1
+            children = self.cost(child_type, node.selection_set, depth + 1)
+            total += own + size * children
+        return total
+
+
+def estimate(
+    schema: GraphQLSchema,
+    operation: OperationDefinitionNode,
+    fragments: dict[str, FragmentDefinitionNode],
+    variables: abc.Mapping[str, object] | None = None,
+    limits: Limits | None = None,
+) -> int:
+    """
+    Estimate how expensive an operation will be from the document alone:
+    each object field is roughly one query, and everything inside a list
+    is counted once per item that the list might return
+    """
+    root = schema.get_root_type(operation.operation)
+    if root is None:
+        return 0
+    estimator = _Estimator(fragments, variables or {}, limits or LIMITS, schema)
+    return estimator.cost(root, operation.selection_set, 1)
+
+
+class QueryCost(SchemaExtension):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.cost: int | None = None
+
+    def get_results(self):
+        return {"queryCost": self.cost}
+
+    def on_execute(self):
+        ctx = self.execution_context
+        document = ctx.graphql_document
+        if document and (operation := get_operation_ast(document, ctx.operation_name)):
+            fragments = {
+                d.name.value: d
+                for d in document.definitions
+                if isinstance(d, FragmentDefinitionNode)
+            }
+            try:
+                self.cost = estimate(
+                    ctx.schema._schema, operation, fragments, ctx.variables
+                )
+                if self.cost > LIMITS.max_cost:
+                    raise QueryTooExpensive(
+                        f"Query is too expensive (cost {self.cost}, max {LIMITS.max_cost})"
+                    )
+            except QueryTooExpensive as e:
+                # refuse to run it at all, rather than failing part-way through
+                ctx.result = ExecutionResult(data=None, errors=[e])
+        yield
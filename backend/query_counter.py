@@ -1,25 +1,173 @@
-from sqlalchemy import event
+import collections
+import contextvars
+import dataclasses
+import inspect
+import json
+import logging
+import time
+import typing as t
+
+from graphql import GraphQLResolveInfo
+from graphql.pyutils import Path
+from sqlalchemy import Result, event
+from sqlalchemy.orm import ORMExecuteState
 from strawberry.extensions import SchemaExtension
 
+log = logging.getLogger(__name__)
+
+# "extensions" adds a profile of every SQL statement to the response (for
+# debugging), "log" writes a summary to the log (for production), and None
+# only counts statements
+MODE: t.Literal["extensions", "log"] | None = "extensions"
+# an identical statement run this many times in one operation is probably
+# a resolver that should be using a DataLoader
+N_PLUS_ONE_THRESHOLD = 5
+# in "log" mode, operations faster than this with no N+1 suspects are
+# only logged at debug level
+SLOW_MS = 100.0
+
+_path: contextvars.ContextVar[Path | None] = contextvars.ContextVar(
+    "resolver_path", default=None
+)
+
+
+def configure(
+    mode: t.Literal["extensions", "log"] | None = "extensions",
+    n_plus_one_threshold: int = 5,
+    slow_ms: float = 100.0,
+) -> None:
+    global MODE, N_PLUS_ONE_THRESHOLD, SLOW_MS
+    MODE = mode
+    N_PLUS_ONE_THRESHOLD = n_plus_one_threshold
+    SLOW_MS = slow_ms
+
+
+def _format_path(path: Path | None) -> str:
+    # list indexes are collapsed, so that one resolver running for every
+    # item in a list is reported as one place
+    if path is None:
+        return ""
+    return ".".join("*" if isinstance(key, int) else key for key in path.as_list())
+
+
+@dataclasses.dataclass
+class Statement:
+    statement: str
+    path: str
+    ms: float = 0.0
+    rows: int | None = None
+
 
 class QueryCounter(SchemaExtension):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.queries = []
+        self.queries: list[Statement] = []
+        self._running: list[tuple[Statement, float]] = []
+        # DBAPI cursor -> its statement, until the ORM has counted its rows
+        self._cursors: dict[t.Any, Statement] = {}
 
     def get_results(self):
+        results: dict[str, t.Any] = {"queryCount": len(self.queries)}
+        if MODE == "extensions":
+            results["sqlProfile"] = self.profile()
+        return results
+
+    def profile(self) -> dict[str, t.Any]:
+        by_statement: dict[str, list[Statement]] = collections.defaultdict(list)
+        for q in self.queries:
+            by_statement[q.statement].append(q)
         return {
-            "queryCount": len(self.queries),
-            # "queries": self.queries,
+            "ms": round(sum(q.ms for q in self.queries), 3),
+            "queries": [dataclasses.asdict(q) for q in self.queries],
+            "nPlusOne": [
+                {
+                    "statement": statement,
+                    "count": len(qs),
+                    "ms": round(sum(q.ms for q in qs), 3),
+                    "paths": sorted({q.path for q in qs}),
+                }
+                for statement, qs in by_statement.items()
+                if len(qs) >= N_PLUS_ONE_THRESHOLD
+            ],
         }
 
-    def callback(self, *args, **kwargs):
-        self.queries.append((args[2], args[3]))
-        if len(self.queries) > 20:  # pragma: no cover
-            raise Exception("Too many queries!")
+    def before_cursor_execute(self, conn, cursor, statement, *args) -> None:
+        q = Statement(statement, _format_path(_path.get()))
+        self.queries.append(q)
+        self._running.append((q, time.perf_counter()))
+
+    def after_cursor_execute(self, conn, cursor, statement, *args) -> None:
+        q, started = self._running.pop()
+        q.ms = round((time.perf_counter() - started) * 1000, 3)
+        # sqlite only knows how many rows were changed, not how many
+        # selected - do_orm_execute counts those
+        if cursor.rowcount >= 0:
+            q.rows = cursor.rowcount
+        else:
+            self._cursors[cursor] = q
+
+    def do_orm_execute(self, state: ORMExecuteState) -> Result | None:
+        # fetch the rows up-front (like the ORM's own result caching
+        # recipe) so that they can be counted, and hand back a copy
+        if state.execution_options.get("yield_per"):
+            return None
+        result = state.invoke_statement()
+        raw = getattr(result, "raw", None)
+        q = self._cursors.pop(raw.cursor, None) if raw is not None else None
+        if q is None:
+            return result
+        frozen = result.freeze()
+        q.rows = len(frozen.data)
+        return frozen()
 
     def on_operation(self):
-        conn = self.execution_context.context["db"].connection()
-        event.listen(conn, "before_cursor_execute", self.callback)
+        db = self.execution_context.context["db"]
+        conn = db.connection()
+        event.listen(conn, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(conn, "after_cursor_execute", self.after_cursor_execute)
+        # only the profile has row counts, so don't pay for them otherwise
+        counting = MODE is not None
+        if counting:
+            event.listen(db, "do_orm_execute", self.do_orm_execute)
         yield
-        event.remove(conn, "before_cursor_execute", self.callback)
+        event.remove(conn, "before_cursor_execute", self.before_cursor_execute)
+        event.remove(conn, "after_cursor_execute", self.after_cursor_execute)
+        if counting:
+            event.remove(db, "do_orm_execute", self.do_orm_execute)
+        if MODE == "log":
+            self.log()
+
+    def log(self) -> None:
+        profile = self.profile()
+        slow = profile["ms"] >= SLOW_MS or profile["nPlusOne"]
+        level = logging.WARNING if slow else logging.DEBUG
+        if not log.isEnabledFor(level):
+            return
+        slowest = sorted(self.queries, key=lambda q: q.ms, reverse=True)[:5]
+        record = {
+            "operation": self.execution_context.operation_name,
+            "queryCount": len(self.queries),
+            "ms": profile["ms"],
+            "nPlusOne": profile["nPlusOne"],
+            "slowest": [dataclasses.asdict(q) for q in slowest],
+        }
+        log.log(level, json.dumps(record))
+
+    def resolve(self, _next, root, info: GraphQLResolveInfo, *args, **kwargs):
+        # remember which field is being resolved, so that the queries it
+        # runs can be blamed on it
+        token = _path.set(info.path)
+        try:
+            result = _next(root, info, *args, **kwargs)
+        finally:
+            _path.reset(token)
+        if inspect.isawaitable(result):
+            return self._resolve_async(result, info.path)
+        return result
+
+    async def _resolve_async(self, result: t.Awaitable, path: Path):
+        token = _path.set(path)
+        try:
+            return await result
+        finally:
+            _path.reset(token)
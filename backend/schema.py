@@ -1,13 +1,25 @@
 # mypy: disable-error-code="misc"
 
+import base64
 import re
 import typing as t
 from typing import TypedDict
 
 import strawberry
 from flask.sessions import SessionMixin
-from sqlalchemy import and_, delete, func, or_, select
-from sqlalchemy.orm import Session
+from sqlalchemy import (
+    ColumnElement,
+    CompoundSelect,
+    Select,
+    and_,
+    delete,
+    literal,
+    or_,
+    select,
+    union,
+)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import InstrumentedAttribute, Session
 from strawberry.permission import BasePermission
 from strawberry.types.info import Info as SInfo
 from strawberry_sqlalchemy_mapper import (
@@ -15,7 +27,13 @@ from strawberry_sqlalchemy_mapper import (
     StrawberrySQLAlchemyMapper,
 )
 
+from . import compare, users
 from . import models as m
+from .async_db import run, uses_db
+from .documents import parser_cache, validation_cache
+from .loaders import Loaders
+from .metrics import Metrics
+from .query_cost import QueryCost
 from .query_counter import QueryCounter
 
 strawberry_sqlalchemy_mapper: StrawberrySQLAlchemyMapper = StrawberrySQLAlchemyMapper()
@@ -28,15 +46,87 @@ Context = TypedDict(
         "cookie": SessionMixin,
         "sqlalchemy_loader": StrawberrySQLAlchemyLoader,
         "cache": dict[str, t.Any],
+        "loaders": Loaders,
     },
 )
 Info = SInfo[Context, None]
 
-visible_combos = [
-    (m.WWW.WILL, m.WWW.WANT),
-    (m.WWW.WANT, m.WWW.WILL),
-    (m.WWW.WANT, m.WWW.WANT),
-]
+visible_combos = compare.visible_combos
+
+# Compare responses with a single SQL query, rather than loading every
+# answer from both responses and comparing them in python
+SQL_COMPARISON: bool = True
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+#############################################
+# Pagination
+#############################################
+
+
+@strawberry.type
+class PageInfo:
+    has_next_page: bool
+    end_cursor: str | None
+
+
+@strawberry.type
+class Edge[T]:
+    cursor: str
+    node: T
+
+
+@strawberry.type
+class Connection[T]:
+    edges: list[Edge[T]]
+    page_info: PageInfo
+
+
+def encode_cursor(id: int) -> str:
+    return base64.urlsafe_b64encode(f"cursor:{id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        prefix, id = base64.urlsafe_b64decode(cursor).decode().split(":")
+        if prefix == "cursor":
+            return int(id)
+    except ValueError:
+        pass
+    raise Exception("Invalid cursor")
+
+
+def paginate(
+    info: Info,
+    stmt: Select[tuple[t.Any]],
+    key: InstrumentedAttribute[int],
+    first: int,
+    after: str | None,
+) -> Connection:
+    """
+    Fetch one page of stmt's results using keyset pagination on key, which
+    needs to be unique and indexed (in practice, the table's primary key)
+    """
+    if first < 1:
+        raise Exception("first must be positive")
+    first = min(first, MAX_PAGE_SIZE)
+    if after:
+        stmt = stmt.where(key > decode_cursor(after))
+    db = info.context["db"]
+    rows = db.scalars(stmt.order_by(key).limit(first + 1)).all()
+    edges = [
+        Edge(cursor=encode_cursor(getattr(row, key.key)), node=row)
+        for row in rows[:first]
+    ]
+    return Connection(
+        edges=edges,
+        page_info=PageInfo(
+            has_next_page=len(rows) > first,
+            end_cursor=edges[-1].cursor if edges else None,
+        ),
+    )
 
 
 #############################################
@@ -68,24 +158,40 @@ class User:
     @strawberry.field(
         permission_classes=[UserOnlyViewOwnUserDetails], graphql_type=list["User"]
     )
+    @uses_db
     def friends(self: m.User, info: Info) -> list[m.User]:
         return list(self.friends)
 
+    @strawberry.field(
+        permission_classes=[UserOnlyViewOwnUserDetails],
+        graphql_type=Connection["User"],
+    )
+    @uses_db
+    def friends_connection(
+        self: m.User, info: Info, first: int = PAGE_SIZE, after: str | None = None
+    ) -> Connection:
+        stmt = select(m.User).where(m.User.id.in_(friend_ids_select(self.id)))
+        return paginate(info, stmt, m.User.id, first, after)
+
     @strawberry.field(
         permission_classes=[UserOnlyViewOwnUserDetails], graphql_type=list["User"]
     )
+    @uses_db
     def friends_outgoing(self: m.User, info: Info) -> list[m.User]:
         return [f.friend_b for f in self.friends_outgoing if not f.confirmed]
 
     @strawberry.field(
         permission_classes=[UserOnlyViewOwnUserDetails], graphql_type=list["User"]
     )
+    @uses_db
     def friends_incoming(self: m.User, info: Info) -> list[m.User]:
         return [f.friend_a for f in self.friends_incoming if not f.confirmed]
 
     @strawberry.field
+    @uses_db
     def is_friend(self: m.User, info: Info) -> bool:
-        return self in get_me_or_die(info, "Anonymous has no friends").friends
+        me = get_me_or_die(info, "Anonymous has no friends")
+        return self.id in friend_ids(info, me)
 
 
 # Surveys
@@ -108,48 +214,97 @@ class Survey:
     __exclude__ = ["user_id"]
 
     @strawberry.field(graphql_type=t.Optional["Response"])
-    def my_response(self: m.Survey, info: Info) -> m.Response | None:
+    async def my_response(self: m.Survey, info: Info) -> m.Response | None:
         db = info.context["db"]
-        user = get_me_or_die(info, "Anonymous users can't view responses")
-        return (
-            db.execute(
-                select(m.Response).where(
-                    m.Response.survey_id == self.id, m.Response.user_id == user.id
-                )
-            )
-            .scalars()
-            .first()
+        user = await run(
+            db, get_me_or_die, info, "Anonymous users can't view responses"
         )
+        return await info.context["loaders"].my_response.load((self.id, user.id))
 
     @strawberry.field(graphql_type=list["Response"])
-    def responses(self: m.Survey, info: Info) -> list[m.Response]:
+    @uses_db
+    def responses(self: m.Survey, info: Info) -> t.Sequence[m.Response]:
+        db = info.context["db"]
+        user = get_me_or_die(info, "Anonymous users can't view responses")
+        return db.scalars(
+            select(m.Response)
+            .where(m.Response.survey_id == self.id, owner_visible_to(user.id))
+            .order_by(m.Response.id)
+        ).all()
+
+    @strawberry.field(graphql_type=Connection["Response"])
+    @uses_db
+    def responses_connection(
+        self: m.Survey, info: Info, first: int = PAGE_SIZE, after: str | None = None
+    ) -> Connection:
         user = get_me_or_die(info, "Anonymous users can't view responses")
-        return [
-            r
-            for r in self.responses
-            if (r.owner == user)
-            or (r.privacy == m.Privacy.PUBLIC)
-            or (r.privacy == m.Privacy.FRIENDS and r.owner in user.friends)
-        ]
+        stmt = select(m.Response).where(
+            m.Response.survey_id == self.id, owner_visible_to(user.id)
+        )
+        return paginate(info, stmt, m.Response.id, first, after)
 
     @strawberry.field(graphql_type=list["Question"])
-    def questions(self: m.Survey) -> t.Iterable[m.Question]:
-        return self.questions.values()
+    @uses_db
+    def questions(
+        self: m.Survey, info: Info, section: str | None = None
+    ) -> t.Sequence[m.Question]:
+        db = info.context["db"]
+        return db.scalars(ordered_questions(self.id, section)).all()
 
     @strawberry.field(graphql_type=t.Optional[SurveyStats])
-    def stats(self: m.Survey, info: Info) -> SurveyStats | None:
-        user = get_me(info)
+    async def stats(self: m.Survey, info: Info) -> SurveyStats | None:
+        user = await run(info.context["db"], get_me, info)
         if not user:
             return None
-        rs = list(self.responses)
-        fs = list(user.friends)
-        friend_responses = len(list(r for r in rs if r.owner in fs))
-        my_responses = len(list(r for r in rs if r.owner == user))
-        return SurveyStats(
-            friend_responses=friend_responses,
-            other_responses=len(rs) - friend_responses - my_responses,
-            unanswered_questions=0,  # FIXME
+        loader = info.context["loaders"].survey_counts
+        counts = await loader.load((self.id, user.id))
+        return SurveyStats(**counts._asdict())
+
+    @strawberry.field(graphql_type=list["BestMatch"])
+    async def best_matches(
+        self: m.Survey, info: Info, limit: int = 10
+    ) -> list[BestMatch]:
+        db = info.context["db"]
+        user = await run(
+            db, get_me_or_die, info, "Anonymous users can't view responses"
         )
+        if limit < 1:
+            raise Exception("limit must be positive")
+        loader = info.context["loaders"].my_response
+        mine = await loader.load((self.id, user.id))
+        if not mine:
+            raise Exception("You haven't responded to this survey")
+
+        def top_matches() -> list[BestMatch]:
+            # everybody in Survey.responses, except me
+            candidates = select(m.Response.id).where(
+                m.Response.survey_id == self.id,
+                m.Response.id != mine.id,
+                owner_visible_to(user.id),
+            )
+            questions = compare.in_packed_order(self.questions.values())
+            top = compare.best_matches(
+                db,
+                questions,
+                # packed outside of the ORM, so read it rather than mine.answer_bits
+                compare.unpack(
+                    db.scalar(
+                        select(m.Response.answer_bits).where(m.Response.id == mine.id)
+                    ),
+                    len(questions),
+                ),
+                candidates,
+                min(limit, MAX_PAGE_SIZE),
+            )
+            responses = {
+                r.id: r
+                for r in db.scalars(
+                    select(m.Response).where(m.Response.id.in_([rid for rid, _ in top]))
+                )
+            }
+            return [BestMatch(response=responses[rid], matches=n) for rid, n in top]
+
+        return await run(db, top_matches)
 
 
 @strawberry.input
@@ -197,20 +352,18 @@ Privacy: t.TypeAlias = strawberry.enum(m.Privacy)  # type: ignore
 
 @strawberry_sqlalchemy_mapper.type(m.Response)
 class Response:
-    __exclude__ = ["user_id", "survey_id"]
+    __exclude__ = ["user_id", "survey_id", "answer_bits"]
 
     @strawberry.field(graphql_type=t.Optional["User"])
+    @uses_db
     def owner(self: m.Response, info: Info) -> m.User | None:
         user = get_me_or_die(info, "Anonymous users can't view responses")
-        if (
-            self.owner == user
-            or self.privacy == m.Privacy.PUBLIC
-            or (self.privacy == m.Privacy.FRIENDS and self.owner in user.friends)
-        ):
+        if can_see_owner(info, user, self):
             return self.owner
         return None
 
     @strawberry.field(graphql_type=list["Answer"])
+    @uses_db
     def answers(self: m.Response, info: Info) -> t.Iterable[m.Answer]:
         user = get_me_or_die(info, "Anonymous users can't view responses")
         if self.owner != user:
@@ -218,65 +371,32 @@ class Response:
         return self.answers.values()
 
     @strawberry.field(graphql_type=list[Comparison])
-    def comparison(self: m.Response, info: Info) -> list[Comparison]:
+    async def comparison(self: m.Response, info: Info) -> list[Comparison]:
         db = info.context["db"]
-        user = get_me_or_die(info, "Anonymous users can't view responses")
-        my_response = (
-            db.execute(
-                select(m.Response).where(
-                    m.Response.survey_id == self.survey.id,
-                    m.Response.user_id == user.id,
-                )
-            )
-            .scalars()
-            .first()
+        user = await run(
+            db, get_me_or_die, info, "Anonymous users can't view responses"
         )
+        loader = info.context["loaders"].my_response
+        my_response = await loader.load((self.survey_id, user.id))
         if not my_response:
             raise Exception("You haven't responded to this survey")
         if self.id == my_response.id:
             raise Exception("You can't compare yourself to yourself")
-        survey: m.Survey = self.survey
-        # return things that we have in common
-        common_answers: list[Comparison] = []
-        for q in survey.questions.values():
-            ma = my_response.answers.get(q.id)
-            ta = self.answers.get(q.id)
-            if ma and ta:
-                if q.flip:
-                    if (ma.value, ta.flip) in visible_combos:
-                        common_answers.append(
-                            Comparison(
-                                section=q.section,
-                                order=q.order,
-                                text=q.text,
-                                flip=q.flip,
-                                mine=ma.value,
-                                theirs=ta.flip,
-                            )
-                        )
-                    if (ma.flip, ta.value) in visible_combos:
-                        common_answers.append(
-                            Comparison(
-                                section=q.section,
-                                order=q.order,
-                                text=q.flip,
-                                flip=q.text,
-                                mine=ma.flip,
-                                theirs=ta.value,
-                            )
-                        )
-                else:
-                    if (ma.value, ta.value) in visible_combos:
-                        common_answers.append(
-                            Comparison(
-                                section=q.section,
-                                order=q.order,
-                                text=q.text,
-                                mine=ma.value,
-                                theirs=ta.value,
-                            )
-                        )
-        return common_answers
+        matches = await run(
+            db,
+            compare.cached_compare,
+            db,
+            my_response,
+            self,
+            compare.sql_compare if SQL_COMPARISON else compare.memory_compare,
+        )
+        return [Comparison(**match._asdict()) for match in matches]
+
+
+@strawberry.type
+class BestMatch:
+    response: Response
+    matches: int
 
 
 #############################################
@@ -287,6 +407,7 @@ class Response:
 @strawberry.type
 class Query:
     @strawberry.field(graphql_type=t.Optional[User])
+    @uses_db
     def user(self, info: Info, username: str | None = None) -> m.User | None:
         me = get_me(info)
         if username:
@@ -298,16 +419,26 @@ class Query:
             return me
 
     @strawberry.field(graphql_type=t.Sequence[Survey])
+    @uses_db
     def surveys(self, info: Info) -> t.Sequence[m.Survey]:
         db = info.context["db"]
         return db.execute(select(m.Survey)).scalars().all()
 
+    @strawberry.field(graphql_type=Connection[Survey])
+    @uses_db
+    def surveys_connection(
+        self, info: Info, first: int = PAGE_SIZE, after: str | None = None
+    ) -> Connection:
+        return paginate(info, select(m.Survey), m.Survey.id, first, after)
+
     @strawberry.field(graphql_type=Survey)
+    @uses_db
     def survey(self, info: Info, survey_id: int) -> m.Survey:
         db = info.context["db"]
         return db.execute(select(m.Survey).where(m.Survey.id == survey_id)).scalar_one()
 
     @strawberry.field(graphql_type=Response)
+    @uses_db
     def response(self, info: Info, response_id: int) -> m.Response:
         user = get_me_or_die(info, "Anonymous users can't view responses")
         db = info.context["db"]
@@ -317,12 +448,8 @@ class Query:
             .first()
         )
         if response and (
-            response.owner == user
-            or response.privacy == m.Privacy.PUBLIC
-            or response.privacy == m.Privacy.ANONYMOUS
-            or (
-                response.privacy == m.Privacy.FRIENDS and response.owner in user.friends
-            )
+            response.privacy == m.Privacy.ANONYMOUS
+            or can_see_owner(info, user, response)
         ):
             return response
         raise Exception("Response doesn't exist, or is private")
@@ -334,6 +461,13 @@ class AnswerInput:
     flip: WWW = WWW.NA
 
 
+@strawberry.input
+class QuestionAnswerInput:
+    question_id: int
+    value: WWW
+    flip: WWW = WWW.NA
+
+
 @strawberry.input
 class ResponseInput:
     privacy: Privacy
@@ -344,27 +478,29 @@ class Mutation:
     ###################################################################
     # Sessions
     @strawberry.mutation(graphql_type=t.Optional[User])
-    def create_user(
+    async def create_user(
         self, info: Info, username: str, password1: str, password2: str, email: str
     ) -> m.User | None:
         db = info.context["db"]
-        user = by_username(info, username)
+        user = await run(db, by_username, info, username)
         if user:
-            if user.check_password(password1):
+            if await check_password(info, user, password1):
+                await upgrade_password(info, user, password1)
                 info.context["cookie"]["username"] = user.username
                 return user
             raise Exception("A user with that name already exists")
 
-        validate_new_username(info, username)
+        await run(db, validate_new_username, info, username)
         validate_new_password(password1, password2)
-        user = m.User(username, password1, email)
+        user = m.User(username, email=email)
+        await user.set_password_async(password1)
         db.add(user)
-        db.flush()
+        await run(db, db.flush)
         info.context["cookie"]["username"] = user.username
         return user
 
     @strawberry.mutation(graphql_type=User)
-    def update_user(
+    async def update_user(
         self,
         info: Info,
         password: str,
@@ -374,28 +510,29 @@ class Mutation:
         email: str,
     ) -> m.User:
         db = info.context["db"]
-        user = get_me_or_die(info, "Anonymous users can't save settings")
+        user = await run(db, get_me_or_die, info, "Anonymous users can't save settings")
 
-        if not user.check_password(password):
+        if not await check_password(info, user, password):
             raise Exception("Current password incorrect")
 
         if username and username != user.username:
-            validate_new_username(info, username)
+            await run(db, validate_new_username, info, username)
             user.username = username
             info.context["cookie"]["username"] = user.username
         if password1:
             validate_new_password(password1, password2)
-            user.set_password(password1)
+            await user.set_password_async(password1)
         if email:
             user.email = email
-        db.flush()
+        await run(db, db.flush)
         return user
 
     @strawberry.mutation(graphql_type=t.Optional[User])
-    def login(self, info: Info, username: str, password: str) -> m.User | None:
-        user = by_username(info, username)
-        if not user or not user.check_password(password):
+    async def login(self, info: Info, username: str, password: str) -> m.User | None:
+        user = await run(info.context["db"], by_username, info, username)
+        if not user or not await check_password(info, user, password):
             raise Exception("User not found")
+        await upgrade_password(info, user, password)
         info.context["cookie"].permanent = True
         info.context["cookie"]["username"] = user.username
         return user
@@ -408,6 +545,7 @@ class Mutation:
     ###################################################################
     # Friendships
     @strawberry.mutation(graphql_type=User)
+    @uses_db
     def add_friend(self, info: Info, username: str) -> m.User:
         db = info.context["db"]
         user = get_me_or_die(info, "Anonymous users can't add friends")
@@ -419,6 +557,7 @@ class Mutation:
         for friendship in user.friends_incoming:
             if friendship.friend_a_id == friend.id:
                 friendship.confirmed = True
+                forget_friends(info, user, friend)
                 db.refresh(user)
                 return user
         for friendship in user.friends_outgoing:
@@ -432,6 +571,7 @@ class Mutation:
         return user
 
     @strawberry.mutation(graphql_type=User)
+    @uses_db
     def remove_friend(self, info: Info, username: str) -> m.User:
         db = info.context["db"]
         user = get_me_or_die(info, "Anonymous users can't remove friends")
@@ -453,11 +593,15 @@ class Mutation:
             )
         )
         db.flush()
+        forget_friends(info, user, friend)
+        for u in (user, friend):
+            db.expire(u, ["friends_incoming", "friends_outgoing"])
         return user
 
     ###################################################################
     # Surveys
     @strawberry.mutation(graphql_type=Survey)
+    @uses_db
     def create_survey(self, info: Info, survey: SurveyInput) -> m.Survey:
         db = info.context["db"]
         user = get_me_or_die(info, "Anonymous users can't create surveys")
@@ -475,6 +619,7 @@ class Mutation:
         return new_survey
 
     @strawberry.mutation(graphql_type=Question)
+    @uses_db
     def add_question(
         self, info: Info, survey_id: int, question: QuestionInput
     ) -> m.Question:
@@ -498,6 +643,7 @@ class Mutation:
         return q
 
     @strawberry.mutation(graphql_type=Question)
+    @uses_db
     def update_question(
         self, info: Info, question_id: int, question: QuestionInput
     ) -> m.Question:
@@ -520,67 +666,136 @@ class Mutation:
     ###################################################################
     # Responses
     @strawberry.mutation(graphql_type=Response)
+    @uses_db
     def save_response(
         self, info: Info, survey_id: int, response: ResponseInput
     ) -> m.Response:
         db = info.context["db"]
         user = get_me_or_die(info, "Anonymous users can't save responses")
-        survey = db.get(m.Survey, survey_id)
-        if not survey:
-            raise Exception("Survey not found")
-
+        # one statement: selecting from survey means that a missing survey
+        # inserts nothing, and ix_response_survey_user turns a second
+        # response into an update of the first
+        stmt = insert(m.Response).from_select(
+            ["survey_id", "user_id", "privacy"],
+            select(
+                m.Survey.id,
+                literal(user.id),
+                _literal(m.Response.privacy, response.privacy),
+            ).where(m.Survey.id == survey_id),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[m.Response.survey_id, m.Response.user_id],
+            set_={"privacy": stmt.excluded.privacy},
+        )
         db_response = db.scalars(
-            select(m.Response).where(
-                m.Response.survey_id == survey.id, m.Response.user_id == user.id
-            )
-        ).first()
+            stmt.returning(m.Response), execution_options={"populate_existing": True}
+        ).one_or_none()
         if not db_response:
-            db_response = m.Response(
-                survey_id=survey.id,
-                user_id=user.id,
-                privacy=response.privacy,
-            )
-            db.add(db_response)
-        else:
-            db_response.privacy = response.privacy
-        db.flush()
+            raise Exception("Survey not found")
         return db_response
 
     @strawberry.mutation(graphql_type=Answer)
+    @uses_db
     def save_answer(
         self, info: Info, question_id: int, answer: AnswerInput
     ) -> m.Answer:
         db = info.context["db"]
         user = get_me_or_die(info, "Anonymous users can't save answers")
-        question = db.get(m.Question, question_id)
-        if not question:
-            raise Exception("Question not found")
-
-        response = (
-            db.execute(
-                select(m.Response).where(
-                    m.Response.survey_id == question.survey_id,
+        # one statement, which inserts nothing if the question doesn't
+        # exist or the user hasn't responded to its survey
+        stmt = insert(m.Answer).from_select(
+            ["response_id", "question_id", "value", "flip"],
+            select(
+                m.Response.id,
+                m.Question.id,
+                _literal(m.Answer.value, answer.value),
+                _literal(m.Answer.flip, answer.flip),
+            )
+            .join(
+                m.Response,
+                and_(
+                    m.Response.survey_id == m.Question.survey_id,
                     m.Response.user_id == user.id,
-                )
+                ),
             )
-            .scalars()
-            .one()
+            .where(m.Question.id == question_id),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[m.Answer.response_id, m.Answer.question_id],
+            set_={"value": stmt.excluded.value, "flip": stmt.excluded.flip},
         )
-        a = db.get(m.Answer, (response.id, question_id))
+        a = db.scalars(
+            stmt.returning(m.Answer), execution_options={"populate_existing": True}
+        ).one_or_none()
         if not a:
-            a = m.Answer(
-                response_id=response.id,
-                question_id=question_id,
-                value=answer.value,
-                flip=answer.flip,
-            )
-            db.add(a)
-        else:
-            a.value = answer.value
-            a.flip = answer.flip
-        db.flush()
+            # only failures pay for finding out why
+            if db.get(m.Question, question_id) is None:
+                raise Exception("Question not found")
+            raise Exception("You haven't responded to this survey")
+        # this doesn't go through a flush, so do what the flush hooks would
+        compare.invalidate_comparisons(db, [a.response_id])
+        compare.pack_answers(db, [a.response_id])
         return a
 
+    @strawberry.mutation(graphql_type=list[Answer])
+    @uses_db
+    def save_answers(
+        self, info: Info, survey_id: int, answers: list[QuestionAnswerInput]
+    ) -> list[m.Answer]:
+        db = info.context["db"]
+        user = get_me_or_die(info, "Anonymous users can't save answers")
+        # the last answer wins if a question is listed twice
+        by_question = {a.question_id: a for a in answers}
+        if not by_question:
+            return []
+
+        found = set(
+            db.scalars(
+                select(m.Question.id).where(
+                    m.Question.survey_id == survey_id,
+                    m.Question.id.in_(by_question),
+                )
+            )
+        )
+        if found != by_question.keys():
+            raise Exception("Question not found")
+        response_id = db.scalar(
+            select(m.Response.id).where(
+                m.Response.survey_id == survey_id, m.Response.user_id == user.id
+            )
+        )
+        if response_id is None:
+            raise Exception("You haven't responded to this survey")
+
+        stmt = insert(m.Answer).values(
+            [
+                {
+                    "response_id": response_id,
+                    "question_id": question_id,
+                    "value": a.value,
+                    "flip": a.flip,
+                }
+                for question_id, a in by_question.items()
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[m.Answer.response_id, m.Answer.question_id],
+            set_={"value": stmt.excluded.value, "flip": stmt.excluded.flip},
+        )
+        # populate_existing updates any of these answers that the session
+        # has already loaded
+        saved = {
+            a.question_id: a
+            for a in db.scalars(
+                stmt.returning(m.Answer),
+                execution_options={"populate_existing": True},
+            )
+        }
+        # this doesn't go through a flush, so do what the flush hooks would
+        compare.invalidate_comparisons(db, [response_id])
+        compare.pack_answers(db, [response_id])
+        return [saved[question_id] for question_id in by_question]
+
 
 #######################################################################
 # Utils
@@ -604,6 +819,27 @@ def validate_new_password(password1: str, password2: str) -> None:
         raise Exception("Bad password")
 
 
+async def check_password(info: Info, user: m.User, password: str) -> bool:
+    # users.cache leaves the hash out, so a user from there loads it now
+    db = info.context["db"]
+    await run(db, getattr, user, "password")
+    return await user.check_password_async(password)
+
+
+async def upgrade_password(info: Info, user: m.User, password: str) -> None:
+    # re-hash old passwords with the current settings while we have the
+    # plain-text password to hand
+    if user.password_needs_rehash():
+        await user.set_password_async(password)
+        db = info.context["db"]
+        await run(db, db.flush)
+
+
+def _literal(column: InstrumentedAttribute, value: t.Any) -> ColumnElement:
+    # a bound parameter with the column's type, eg to store an enum by name
+    return literal(value, column.type)
+
+
 def get_me(info: Info) -> m.User | None:
     return by_username(info, info.context["cookie"].get("username"))
 
@@ -615,15 +851,70 @@ def get_me_or_die(info: Info, msg: str) -> m.User:
     return user
 
 
+def ordered_questions(
+    survey_id: int, section: str | None = None
+) -> Select[tuple[m.Question]]:
+    stmt = select(m.Question).where(m.Question.survey_id == survey_id)
+    if section is not None:
+        stmt = stmt.where(m.Question.section == section)
+    return stmt.order_by(m.Question.order, m.Question.id)
+
+
+def friend_ids_select(user_id: int) -> CompoundSelect:
+    return union(
+        select(m.Friendship.friend_b_id).where(
+            m.Friendship.friend_a_id == user_id, m.Friendship.confirmed
+        ),
+        select(m.Friendship.friend_a_id).where(
+            m.Friendship.friend_b_id == user_id, m.Friendship.confirmed
+        ),
+    )
+
+
+def friend_ids(info: Info, user: m.User) -> set[int]:
+    cache = info.context["cache"]
+    db = info.context["db"]
+    key = f"friends-{user.id}"
+    if key not in cache:
+        cache[key] = set(db.scalars(friend_ids_select(user.id)))
+    return cache[key]
+
+
+def forget_friends(info: Info, *users: m.User) -> None:
+    for user in users:
+        info.context["cache"].pop(f"friends-{user.id}", None)
+
+
+def can_see_owner(info: Info, user: m.User, response: m.Response) -> bool:
+    return (
+        response.user_id == user.id
+        or response.privacy == m.Privacy.PUBLIC
+        or (
+            response.privacy == m.Privacy.FRIENDS
+            and response.user_id in friend_ids(info, user)
+        )
+    )
+
+
+def owner_visible_to(user_id: int) -> ColumnElement[bool]:
+    # the SQL version of can_see_owner
+    return or_(
+        m.Response.user_id == user_id,
+        m.Response.privacy == m.Privacy.PUBLIC,
+        and_(
+            m.Response.privacy == m.Privacy.FRIENDS,
+            m.Response.user_id.in_(friend_ids_select(user_id)),
+        ),
+    )
+
+
 def by_username(info: Info, username: str | None) -> m.User | None:
     if not username:
         return None
     cache = info.context["cache"]
-    db = info.context["db"]
     key = f"user-{username}"
     if key not in cache:
-        stmt = select(m.User).where(func.lower(m.User.username) == func.lower(username))
-        cache[key] = db.execute(stmt).scalars().first()
+        cache[key] = users.by_username(info.context["db"], username)
     return cache[key]
 
 
@@ -631,4 +922,14 @@ def by_username(info: Info, username: str | None) -> m.User | None:
 # Schema
 
 strawberry_sqlalchemy_mapper.finalize()
-schema = strawberry.Schema(query=Query, mutation=Mutation, extensions=[QueryCounter])
+schema = strawberry.Schema(
+    query=Query,
+    mutation=Mutation,
+    extensions=[
+        QueryCounter,
+        QueryCost,
+        parser_cache,
+        validation_cache,
+        Metrics,
+    ],
+)
@@ -0,0 +1,77 @@
+import itertools
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from . import models as m
+from .cache import TTLCache
+
+DEFAULT_CACHE_SIZE = 10_000
+DEFAULT_CACHE_TTL = 60.0
+
+# lower-case username -> the user's columns, so that looking up the logged-in
+# user doesn't need a query on every request. Each process has its own copy,
+# so changes made by another worker show up after at most one TTL.
+cache = TTLCache[str, dict[str, object]](
+    max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL
+)
+
+# everything except the password hash, which would let an old password keep
+# working in other workers after it's changed - it's loaded from the database
+# when it's checked instead
+_COLUMNS = [c.key for c in inspect(m.User).column_attrs if c.key != "password"]
+
+
+def configure(size: int = DEFAULT_CACHE_SIZE, ttl: float = DEFAULT_CACHE_TTL) -> None:
+    cache.max_size = size
+    cache.ttl = ttl
+    cache.clear()
+
+
+def by_username(db: Session, username: str) -> m.User | None:
+    """
+    Find a user by case-insensitive username, attached to the given session
+    """
+    key = username.lower()
+    if snapshot := cache.get(key):
+        # build a detached copy without calling User.__init__, then attach
+        # it without going back to the database
+        user = inspect(m.User).class_manager.new_instance()
+        for name, value in snapshot.items():
+            setattr(user, name, value)
+        make_transient_to_detached(user)
+        return db.merge(user, load=False)
+
+    stmt = select(m.User).where(func.lower(m.User.username) == key)
+    user = db.execute(stmt).scalars().first()
+    if user:
+        cache.set(key, {name: getattr(user, name) for name in _COLUMNS})
+    return user
+
+
+def forget(*usernames: str | None) -> None:
+    for username in usernames:
+        if username:
+            cache.pop(username.lower())
+
+
+@event.listens_for(Session, "before_flush")
+def _forget_changed_users(db: Session, flush_context, instances) -> None:
+    # renames, password changes (including re-hashes), and new users all
+    # drop their cache entries - for renames, both the old and new names
+    stale: set[str] = db.info.setdefault("stale_usernames", set())
+    for obj in itertools.chain(db.new, db.dirty, db.deleted):
+        if isinstance(obj, m.User):
+            if obj in db.dirty and not db.is_modified(obj, include_collections=False):
+                # only their friendships changed
+                continue
+            history = inspect(obj).attrs.username.history
+            stale.update(name for name in itertools.chain(*history) if name is not None)
+    forget(*stale)
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_committed_users(db: Session) -> None:
+    # forget them again once the change is visible to other sessions, in
+    # case one of them re-cached the old row in the meantime
+    forget(*db.info.pop("stale_usernames", ()))
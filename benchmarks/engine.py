@@ -0,0 +1,88 @@
+"""
+Concurrent read/write throughput against a SQLite file, using the engine
+settings from create_app's default config, compared to a plain engine.
+Each worker is a separate process, like a gunicorn worker.
+
+    uv run python -m benchmarks.engine [--workers 4] [--seconds 10]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import exc, update
+from sqlalchemy.orm import Session
+
+from backend import models as m
+from backend.app import create_app, create_db_engine
+
+PLAIN = {
+    "SQLALCHEMY_POOL_PRE_PING": False,
+    "SQLITE_PRAGMAS": {},
+}
+
+
+def worker(config: dict, seconds: float, seed: int) -> tuple[int, int, int]:
+    engine = create_db_engine(config)
+    rng = random.Random(seed)
+    reads = writes = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            with Session(engine) as db:
+                if rng.random() < 0.2:
+                    db.execute(
+                        update(m.Answer)
+                        .where(m.Answer.response_id == rng.randint(1, 5))
+                        .values(value=rng.choice(list(m.WWW)))
+                    )
+                    db.commit()
+                    writes += 1
+                else:
+                    response = db.get(m.Response, rng.randint(1, 5))
+                    assert response and response.answers
+                    reads += 1
+        except exc.OperationalError:
+            # "database is locked"
+            errors += 1
+    return reads, writes, errors
+
+
+def run(name: str, config: dict, workers: int, seconds: float) -> None:
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.starmap(
+            worker, [(config, seconds, seed) for seed in range(workers)]
+        )
+    reads, writes, errors = (sum(r[n] for r in results) for n in range(3))
+    print(
+        f"{name:>6}: {reads / seconds:8.0f} reads/s "
+        f"{writes / seconds:8.0f} writes/s {errors:6d} lock errors"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, overrides in [("plain", PLAIN), ("tuned", {})]:
+            path = os.path.join(tmp, f"{name}.sqlite")
+            uri = f"sqlite:///{path}"
+            config = {
+                **create_app({"SQLALCHEMY_DATABASE_URI": uri}).config,
+                **overrides,
+            }
+            engine = create_db_engine(config)
+            m.Base.metadata.create_all(engine)
+            m.populate_example_data(Session(engine))
+            engine.dispose()
+            run(name, config, args.workers, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Survey.bestMatches against a SQLite file with one large survey: the time
+to rank every response against one user's, compared to running the
+per-response comparison (what the UI did before) for every one of them.
+
+    uv run python -m benchmarks.matches [--responses 20000] [--questions 300]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import Session
+
+from backend import compare
+from backend import models as m
+
+
+def populate(engine, responses: int, questions: int, rng: random.Random) -> None:
+    wwws = list(m.WWW)
+    with engine.begin() as conn:
+        conn.execute(
+            insert(m.User), [{"username": "owner", "password": "", "email": ""}]
+        )
+        conn.execute(
+            insert(m.Survey),
+            [{"name": "Big", "description": "", "long_description": "", "user_id": 1}],
+        )
+        conn.execute(
+            insert(m.Question),
+            [
+                {
+                    "survey_id": 1,
+                    "order": float(n),
+                    "text": f"q{n}",
+                    "flip": f"flip{n}" if n % 4 == 0 else None,
+                }
+                for n in range(questions)
+            ],
+        )
+        conn.execute(
+            insert(m.Response),
+            [
+                {"survey_id": 1, "user_id": n + 1, "privacy": m.Privacy.PUBLIC}
+                for n in range(responses)
+            ],
+        )
+        batch = 100_000
+        answers = (
+            {
+                "response_id": r + 1,
+                "question_id": q + 1,
+                "value": rng.choice(wwws),
+                "flip": rng.choice(wwws),
+            }
+            for r in range(responses)
+            for q in range(questions)
+            if rng.random() > 0.2
+        )
+        while rows := [row for _, row in zip(range(batch), answers)]:
+            conn.execute(insert(m.Answer), rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--responses", type=int, default=20_000)
+    parser.add_argument("--questions", type=int, default=300)
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'matches.sqlite')}")
+        m.Base.metadata.create_all(engine)
+        populate(engine, args.responses, args.questions, random.Random(0))
+        start = time.perf_counter()
+        compare.rebuild_answer_bits(engine)
+        packed = time.perf_counter() - start
+        print(f"    packing: {packed * 1000:8.1f}ms (once, with pack-answers)")
+
+        with Session(engine) as db:
+            survey = db.get_one(m.Survey, 1)
+            mine = db.get_one(m.Response, 1)
+            questions = compare.in_packed_order(survey.questions.values())
+            my_answers = compare.unpack(mine.answer_bits, len(questions))
+            others = select(m.Response.id).where(
+                m.Response.survey_id == 1, m.Response.id != mine.id
+            )
+
+            start = time.perf_counter()
+            top = compare.best_matches(db, questions, my_answers, others, args.limit)
+            ranked = time.perf_counter() - start
+            print(f"bestMatches: {ranked * 1000:8.1f}ms for {args.responses} responses")
+            print(f"        top: {top[:3]}")
+
+            # how much of that is reading the answers, rather than scoring
+            start = time.perf_counter()
+            vectors = list(compare.answer_vectors(db, len(questions), others))
+            loaded = time.perf_counter() - start
+            scorer = compare.Scorer(questions, my_answers)
+            start = time.perf_counter()
+            for _, theirs in vectors:
+                scorer.score(theirs)
+            scored = time.perf_counter() - start
+            print(f"    loading: {loaded * 1000:8.1f}ms")
+            print(f"    scoring: {scored * 1000:8.1f}ms")
+
+            # one comparison per response, extrapolated from a sample
+            sample = db.scalars(
+                select(m.Response).where(m.Response.id != mine.id).limit(100)
+            ).all()
+            start = time.perf_counter()
+            for theirs in sample:
+                compare.sql_compare(db, mine, theirs)
+            each = (time.perf_counter() - start) / len(sample)
+            print(f"   one each: {each * args.responses * 1000:8.1f}ms (estimated)")
+
+
+if __name__ == "__main__":
+    main()
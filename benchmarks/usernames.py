@@ -0,0 +1,73 @@
+"""
+Case-insensitive username lookups against a SQLite file with lots of
+users, before and after upgrade_schema adds the lower(username) index.
+
+    uv run python -m benchmarks.usernames [--users 1000000] [--lookups 1000]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, func, insert, select, text
+
+from backend import models as m
+
+
+def lookups(engine, names: list[str]) -> float:
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        for name in names:
+            stmt = select(m.User.id).where(func.lower(m.User.username) == name.lower())
+            assert conn.execute(stmt).scalar() is not None
+    return len(names) / (time.perf_counter() - start)
+
+
+def plan(engine) -> str:
+    stmt = select(m.User.id).where(func.lower(m.User.username) == "user1")
+    sql = str(stmt.compile(engine, compile_kwargs={"literal_binds": True}))
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+    return "; ".join(row[-1] for row in rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    names = [f"User{rng.randrange(args.users)}" for _ in range(args.lookups)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'users.sqlite')}")
+        m.Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            # what an existing database looks like before upgrade-db
+            conn.execute(text("DROP INDEX ix_user_username_lower"))
+            batch = 100_000
+            for start in range(0, args.users, batch):
+                conn.execute(
+                    insert(m.User),
+                    [
+                        {"username": f"User{n}", "password": "x", "email": ""}
+                        for n in range(start, min(start + batch, args.users))
+                    ],
+                )
+
+        print(f"before: {plan(engine)}")
+        print(f"before: {lookups(engine, names[:50]):10.1f} lookups/s")
+
+        start = time.perf_counter()
+        m.upgrade_schema(engine)
+        print(f"upgrade-db took {time.perf_counter() - start:.1f}s")
+
+        print(f" after: {plan(engine)}")
+        print(f" after: {lookups(engine, names):10.1f} lookups/s")
+
+
+if __name__ == "__main__":
+    main()
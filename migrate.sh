@@ -1,5 +1,5 @@
 #!/bin/sh
-python3 backend/models.py
+python3 -m backend.models
 sqlite3 data/link2.sqlite <<EOF
 ATTACH DATABASE 'data/link1.sqlite' AS old;
 